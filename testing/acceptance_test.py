@@ -1,5 +1,5 @@
 import py
-import sys
+import sys, os
 
 class TestDistribution:
     def test_n1_pass(self, testdir):
@@ -263,6 +263,46 @@ class TestDistribution:
         child.close()
         #assert ret == 2
 
+class TestDistLoadTime:
+    def test_records_and_uses_timings(self, testdir):
+        testdir.makepyfile("""
+            def test_one():
+                pass
+            def test_two():
+                pass
+        """)
+        timings = testdir.tmpdir.join(".xdist-timings")
+        result = testdir.runpytest("--dist=loadtime", "--tx=2*popen")
+        assert not result.ret
+        result.stdout.fnmatch_lines(["*2 pass*"])
+        assert timings.check()
+        durations = py.std.json.loads(timings.read())
+        assert len(durations) == 2
+        result = testdir.runpytest("--dist=loadtime", "--tx=2*popen")
+        assert not result.ret
+        result.stdout.fnmatch_lines(["*2 pass*"])
+
+class TestDistLoadScope:
+    def test_module_on_one_node(self, testdir):
+        for name in "test_a", "test_b":
+            testdir.makepyfile(**{name: """
+                def test_1(): pass
+                def test_2(): pass
+                def test_3(): pass
+                def test_4(): pass
+            """})
+        result = testdir.runpytest("-v", "--dist=loadfile", "--tx=2*popen")
+        assert not result.ret
+        result.stdout.fnmatch_lines(["*8 pass*"])
+        module2nodes = {}
+        for line in result.stdout.lines:
+            m = py.std.re.search(r"\[(gw\d)\] PASSED (\w+\.py)", line)
+            if m:
+                module2nodes.setdefault(m.group(2), set()).add(m.group(1))
+        assert sorted(module2nodes) == ["test_a.py", "test_b.py"]
+        for nodes in module2nodes.values():
+            assert len(nodes) == 1
+
 class TestDistEach:
     def test_simple(self, testdir):
         testdir.makepyfile("""
@@ -320,6 +360,17 @@ class TestTerminalReporting:
             "E       assert 0",
         ])
 
+    def test_node_startup_time(self, testdir):
+        testdir.makepyfile("""
+            def test_ok():
+                pass
+        """)
+        result = testdir.runpytest("-n2", "-v", "--setup-concurrency=1")
+        result.stdout.fnmatch_lines_random([
+            "[[]gw0[]] Python *started in *s*",
+            "[[]gw1[]] Python *started in *s*",
+        ])
+
     def test_fail_platinfo(self, testdir):
         p = testdir.makepyfile("""
             def test_func():
@@ -334,6 +385,16 @@ class TestTerminalReporting:
             "E       assert 0",
         ])
 
+    def test_junitxml_passed_output(self, testdir):
+        testdir.makepyfile("""
+            def test_ok():
+                print ("hello from slave")
+        """)
+        result = testdir.runpytest("-n1", "--junitxml=junit.xml")
+        assert result.ret == 0
+        xml = testdir.tmpdir.join("junit.xml").read()
+        assert "hello from slave" in xml
+
 def test_teardownfails_one_function(testdir):
     p = testdir.makepyfile("""
         def test_func():
@@ -428,6 +489,278 @@ def test_crashing_item(testdir):
         "*1 failed*1 passed*"
     ])
 
+def test_crashing_slave_replaced(testdir):
+    p = testdir.makepyfile("""
+        import os
+        def test_crash_1():
+            os._exit(1)
+        def test_crash_2():
+            os._exit(1)
+        def test_noncrash_1():
+            pass
+        def test_noncrash_2():
+            pass
+    """)
+    result = testdir.runpytest("-n1", p)
+    result.stdout.fnmatch_lines([
+        "*replacing slave*",
+        "*2 failed*2 passed*"
+    ])
+
+def test_crash_during_shutdown(testdir):
+    p = testdir.makepyfile("""
+        import os, time
+        def test_crash():
+            # the other node finished and was told to shut down
+            time.sleep(1.0)
+            os._exit(1)
+        def test_short():
+            pass
+        def test_pass_1():
+            pass
+        def test_pass_2():
+            pass
+    """)
+    result = testdir.runpytest("-n2", p)
+    result.stdout.fnmatch_lines([
+        "*replacing slave*",
+        "*1 failed*3 passed*"
+    ])
+    assert "INTERNALERROR" not in result.stdout.str()
+    assert "INTERNALERROR" not in result.stderr.str()
+
+@py.test.mark.skipif("not hasattr(os, 'fork')")
+def test_boxed_crash_not_rerun(testdir):
+    p = testdir.makepyfile("""
+        import os
+        def test_crash():
+            os._exit(1)
+        def test_kill():
+            os.kill(os.getpid(), 15)
+        def test_pass_1():
+            pass
+        def test_pass_2():
+            pass
+    """)
+    result = testdir.runpytest("-n2", "--boxed", p)
+    result.stdout.fnmatch_lines([
+        "*CRASHED*",
+        "*2 failed*2 passed*"
+    ])
+    assert "replacing slave" not in result.stdout.str()
+    assert result.ret == 1
+
+@py.test.mark.skipif("sys.platform == 'win32'")
+def test_replacement_fails(testdir):
+    starts = testdir.tmpdir.join("starts")
+    python = testdir.tmpdir.join("python")
+    python.write("\n".join([
+        "#!/bin/sh",
+        "echo >> %s" % starts,
+        # the two nodes start, their replacement does not
+        "if [ $(wc -l < %s) -gt 2 ]; then exit 1; fi" % starts,
+        'exec %s "$@"' % sys.executable,
+    ]) + "\n")
+    python.chmod(int("755", 8))
+    tests = ["def test_%d(): pass" % i for i in range(20)]
+    p = testdir.makepyfile("\n".join(
+        ["import os", "def test_crash():", "    os._exit(1)"] + tests))
+    result = testdir.runpytest("-d", "--tx=2*popen//python=%s" % python, p)
+    result.stdout.fnmatch_lines([
+        "*replacing slave*",
+        "*could not start slave*",
+        "*1 failed*20 passed*"
+    ])
+    assert result.ret == 1
+    assert "INTERNALERROR" not in result.stdout.str()
+
+def test_finish_while_replacement_starts(testdir):
+    testdir.makeconftest("""
+        import time
+        def pytest_configure(config):
+            slaveinput = getattr(config, "slaveinput", {})
+            if slaveinput.get("slaveid") == "gw2":
+                time.sleep(2.0)
+    """)
+    tests = ["def test_%d(): pass" % i for i in range(10)]
+    p = testdir.makepyfile("\n".join(
+        ["import os", "def test_crash():", "    os._exit(1)"] + tests))
+    result = testdir.runpytest("-n2", p)
+    result.stdout.fnmatch_lines([
+        "*replacing slave*",
+        "*1 failed*10 passed*"
+    ])
+    assert result.ret == 1
+    assert "INTERNALERROR" not in result.stdout.str()
+    assert "INTERNALERROR" not in result.stderr.str()
+
+@py.test.mark.skipif("not hasattr(os, 'fork')")
+def test_zygote(testdir):
+    p = testdir.makepyfile("""
+        import os
+        def test_ok():
+            pass
+        def test_crash():
+            os._exit(1)
+        def test_fail():
+            assert 0
+    """)
+    result = testdir.runpytest("-n2", "--zygote", p)
+    result.stdout.fnmatch_lines([
+        "*2 failed*1 passed*"
+    ])
+
+@py.test.mark.skipif("not hasattr(os, 'fork')")
+def test_collect_once(testdir):
+    pids = testdir.tmpdir.join("pids")
+    testdir.makeconftest("""
+        import os
+        def pytest_collection_modifyitems(items):
+            f = open(%r, "a")
+            f.write("%%d\\n" %% os.getpid())
+            f.close()
+    """ % str(pids))
+    p = testdir.makepyfile("""
+        import os
+        def test_ok():
+            pass
+        def test_crash():
+            os._exit(1)
+        def test_fail():
+            assert 0
+    """)
+    result = testdir.runpytest("-n2", "--collect-once", p)
+    result.stdout.fnmatch_lines([
+        "*2 failed*1 passed*"
+    ])
+    # the replacement of the crashed slave is forked from the zygote too
+    assert len(pids.readlines()) == 1
+
+@py.test.mark.skipif("not hasattr(os, 'fork')")
+def test_collect_once_error(testdir):
+    testdir.makepyfile(test_ok="def test_ok(): pass",
+                       test_error="syntax error(")
+    result = testdir.runpytest("-n2", "--collect-once")
+    result.stdout.fnmatch_lines([
+        "*ERROR collecting*test_error.py*",
+        "*1 passed*1 error*"
+    ])
+
+@py.test.mark.skipif("not hasattr(os, 'fork')")
+def test_collect_once_slow_collection(testdir):
+    testdir.makeconftest("""
+        import time
+        import xdist.slavemanage
+        # collecting takes longer than forking a slave may
+        xdist.slavemanage.Zygote.TIMEOUT = 0.5
+        def pytest_collection_modifyitems(config):
+            if getattr(config, "slaveinput", {}).get("slaveid") == "zygote":
+                time.sleep(2.0)
+    """)
+    p = testdir.makepyfile("""
+        def test_ok():
+            pass
+    """)
+    result = testdir.runpytest("-n2", "--collect-once", p)
+    result.stdout.fnmatch_lines([
+        "*1 passed*"
+    ])
+    assert result.ret == 0
+
+@py.test.mark.skipif("not hasattr(os, 'fork')")
+def test_pool(testdir):
+    path = testdir.tmpdir.join("pool")
+    proc = py.std.subprocess.Popen([sys.executable, "-m", "xdist.pool",
+                                    str(path)])
+    try:
+        for i in range(100):
+            if path.check():
+                break
+            py.std.time.sleep(0.1)
+        p = testdir.makepyfile("""
+            import os
+            def test_ok():
+                pass
+            def test_crash():
+                os._exit(1)
+            def test_fail():
+                assert 0
+        """)
+        for i in range(2):
+            result = testdir.runpytest("-d", "--tx=2*pool=%s" % path, p)
+            result.stdout.fnmatch_lines([
+                "*2 failed*1 passed*"
+            ])
+    finally:
+        proc.terminate()
+        proc.wait()
+
+def test_max_slave_tests(testdir):
+    pids = testdir.tmpdir.join("pids")
+    p = testdir.makepyfile("""
+        import os, time
+        def pytest_funcarg__pid(request):
+            time.sleep(0.1)
+            f = open(%r, "a")
+            f.write("%%d\\n" %% os.getpid())
+            f.close()
+        def test_1(pid): pass
+        def test_2(pid): pass
+        def test_3(pid): pass
+        def test_4(pid): pass
+        def test_5(pid): pass
+        def test_6(pid): pass
+    """ % str(pids))
+    result = testdir.runpytest("-n1", "--max-slave-tests=2", p)
+    assert not result.ret
+    result.stdout.fnmatch_lines([
+        "*replacing slave which ran 2 tests*",
+        "*6 passed*"
+    ])
+    assert len(set(pids.readlines())) >= 2
+
+@py.test.mark.skipif("sys.platform == 'win32'")
+def test_max_slave_tests_replacement_fails(testdir):
+    starts = testdir.tmpdir.join("starts")
+    python = testdir.tmpdir.join("python")
+    python.write("\n".join([
+        "#!/bin/sh",
+        "echo >> %s" % starts,
+        # only the first slave starts, its replacement does not
+        "if [ $(wc -l < %s) -gt 1 ]; then exit 1; fi" % starts,
+        'exec %s "$@"' % sys.executable,
+    ]) + "\n")
+    python.chmod(int("755", 8))
+    tests = ["def test_%d(): time.sleep(0.1)" % i for i in range(12)]
+    p = testdir.makepyfile("\n".join(["import time"] + tests))
+    result = testdir.runpytest("-d", "--tx=popen//python=%s" % python,
+                               "--tx=popen", "--max-slave-tests=3", p)
+    result.stdout.fnmatch_lines([
+        "*gw0] replacing slave which ran 3 tests*",
+        "*could not start slave*",
+        "*12 passed*"
+    ])
+    assert result.ret == 0
+    assert "INTERNALERROR" not in result.stdout.str()
+
+def test_max_slave_restart(testdir):
+    p = testdir.makepyfile("""
+        import os
+        def test_crash_1():
+            os._exit(1)
+        def test_crash_2():
+            os._exit(1)
+        def test_crash_3():
+            os._exit(1)
+        def test_noncrash():
+            pass
+    """)
+    result = testdir.runpytest("-n1", "--max-slave-restart=1", p)
+    assert result.ret
+    result.stdout.fnmatch_lines([
+        "*maximum slave restart count reached (1)*",
+    ])
+
 
 
 def test_skipping(testdir):
@@ -1,7 +1,12 @@
 from xdist.dsession import (
     DSession,
     LoadScheduling,
+    LoadTimeScheduling,
+    LoadScopeScheduling,
+    LoadFileScheduling,
     EachScheduling,
+    TimingStore,
+    EventQueue,
     report_collection_diff,
 )
 from _pytest import main as outcome
@@ -22,11 +27,33 @@ class MockGateway:
     def __init__(self):
         self.id = str(self._count)
         self._count += 1
+        self.spec = XSpec("popen")
+
+class MockNodeManager:
+    def __init__(self):
+        self.started = []
+        self.nodes = []
+        self.error = None
+
+    def make_node_gateway(self, spec):
+        self.started.append(spec)
+        if self.error is not None:
+            raise self.error
+        return MockGateway()
+
+    def start_node(self, gateway, putevent):
+        node = MockNode()
+        node.gateway = gateway
+        self.nodes.append(node)
+        return node
 
 class MockNode:
     def __init__(self):
         self.sent = []
+        self.steal_requests = []
+        self.collection_requests = 0
         self.gateway = MockGateway()
+        self.slaveoutput = {'exitstatus': 0}
 
     def send_runtest(self, nodeid):
         self.sent.append(nodeid)
@@ -34,12 +61,28 @@ class MockNode:
     def send_runtest_all(self):
         self.sent.append("ALL")
 
-    def sendlist(self, items):
+    def send_steal(self, items):
+        self.steal_requests.append(items)
+
+    def send_collection_request(self):
+        self.collection_requests += 1
+
+    def send_runtest_some(self, items):
         self.sent.extend(items)
 
     def shutdown(self):
         self._shutdown=True
 
+def item_ids(sched, indices):
+    """ return the ids of the items with the given collection indices. """
+    return [sched.collection[i] for i in indices]
+
+def process_started(dsession):
+    """ process the events of the gateways made in threads. """
+    while dsession._starting:
+        for name, kwargs in dsession.queue.getall(timeout=10.0):
+            getattr(dsession, "slave_" + name)(**kwargs)
+
 def dumpqueue(queue):
     while queue.qsize():
         print(queue.get())
@@ -63,9 +106,9 @@ class TestEachScheduling:
         assert sched.tests_finished()
         assert node1.sent == ['ALL']
         assert node2.sent == ['ALL']
-        sched.remove_item(node1, collection[0])
+        sched.remove_item(node1, 0)
         assert sched.tests_finished()
-        sched.remove_item(node2, collection[0])
+        sched.remove_item(node2, 0)
         assert sched.tests_finished()
 
     def test_schedule_remove_node(self):
@@ -80,10 +123,45 @@ class TestEachScheduling:
         sched.init_distribute()
         assert sched.tests_finished()
         crashitem = sched.remove_node(node1)
-        assert crashitem
+        assert crashitem == collection[0]
         assert sched.tests_finished()
         assert not sched.hasnodes()
 
+    def test_replacement_runs_leftover(self):
+        node1 = MockNode()
+        sched = EachScheduling(1)
+        sched.addnode(node1)
+        collection = ["a.py::test_1", "a.py::test_2", "a.py::test_3"]
+        sched.addnode_collection(node1, collection)
+        sched.init_distribute()
+        sched.remove_item(node1, 0)
+        crashitem = sched.remove_node(node1)
+        assert crashitem == collection[1]
+        assert not sched.tests_finished()
+        node2 = MockNode()
+        sched.addnode(node2)
+        sched.addnode_collection(node2, collection)
+        assert node2.sent == [2]
+        assert sched.tests_finished()
+        sched.remove_item(node2, 2)
+        assert not sched.remove_node(node2)
+
+    def test_leftover_unrunnable(self):
+        node1 = MockNode()
+        sched = EachScheduling(1)
+        sched.addnode(node1)
+        collection = ["a.py::test_1", "a.py::test_2", "a.py::test_3"]
+        sched.addnode_collection(node1, collection)
+        sched.init_distribute()
+        node2 = MockNode()
+        sched.addnode(node2)
+        assert sched.remove_node(node1) == collection[0]
+        # node2 may replace node1 once it collected
+        assert sched.remove_unrunnable() == []
+        sched.shutdown_node(node2)
+        assert sorted(sched.remove_unrunnable()) == collection[1:]
+        assert sched.tests_finished()
+
 class TestLoadScheduling:
     def test_schedule_load_simple(self):
         node1 = MockNode()
@@ -103,37 +181,127 @@ class TestLoadScheduling:
         assert sched.tests_finished()
         assert len(node1.sent) == 1
         assert len(node2.sent) == 1
-        x = sorted(node1.sent + node2.sent)
+        x = sorted(item_ids(sched, node1.sent + node2.sent))
         assert x == collection
         sched.remove_item(node1, node1.sent[0])
         sched.remove_item(node2, node2.sent[0])
         assert sched.tests_finished()
         assert not sched.pending
 
-    def test_init_distribute_chunksize(self):
+    def test_dispatch_before_all_collected(self):
+        sched = LoadScheduling(2)
+        node1 = MockNode()
+        node2 = MockNode()
+        sched.addnode(node1)
+        sched.addnode(node2)
+        col = ["xyz%d" % i for i in range(20)]
+        sched.addnode_collection(node1, col)
+        assert not sched.collection_is_completed
+        assert node1.sent == [0, 1]
+        assert not node2.sent
+        # nodes which did not collect yet do not get or give items
+        while sched.node2pending[node1]:
+            sched.remove_item(node1, sched.node2pending[node1][0])
+        assert not node2.sent
+        assert not node2.steal_requests
+        assert not sched.tests_finished()
+        assert sorted(node1.sent) == list(range(20))
+        sched.addnode_collection(node2, list(col))
+        assert sched.collection_is_completed
+        assert not node2.sent
+        assert sched.tests_finished()
+
+    def test_first_batch_leaves_share_for_other_nodes(self):
+        sched = LoadScheduling(3)
+        nodes = [MockNode() for i in range(3)]
+        for node in nodes:
+            sched.addnode(node)
+        col = ["xyz%d" % i for i in range(3)]
+        for node in nodes:
+            sched.addnode_collection(node, col)
+        assert [node.sent for node in nodes] == [[0], [1], [2]]
+
+    def test_different_collection_reported(self):
+        sched = LoadScheduling(2)
+        node1 = MockNode()
+        node2 = MockNode()
+        sched.addnode(node1)
+        sched.addnode(node2)
+        sched.addnode_collection(node1, ["a::test_1", "a::test_2"])
+        py.test.raises(AssertionError, lambda:
+            sched.addnode_collection(node2, ["a::test_1", "a::test_3"]))
+        assert not node2.sent
+
+    def test_init_distribute_batchsize(self):
         sched = LoadScheduling(2)
         node1 = MockNode()
         node2 = MockNode()
         sched.addnode(node1)
         sched.addnode(node2)
-        sched.ITEM_CHUNKSIZE = 2
-        col = ["xyz"] * (2*sched.ITEM_CHUNKSIZE +1)
+        col = ["xyz%d" % i for i in range(20)]
         sched.addnode_collection(node1, col)
         sched.addnode_collection(node2, col)
         sched.init_distribute()
-        #assert not sched.tests_finished()
+        # 20 // (2 nodes * BATCH_DIVISOR) items per node
         sent1 = node1.sent
         sent2 = node2.sent
-        chunkitems = col[:sched.ITEM_CHUNKSIZE]
-        assert sent1 == chunkitems
-        assert sent2 == chunkitems
-        assert sched.node2pending[node1] == sent1
-        assert sched.node2pending[node2] == sent2
-        assert len(sched.pending) == 1
+        assert sent1 == [0, 1]
+        assert sent2 == [2, 3]
+        assert list(sched.node2pending[node1]) == sent1
+        assert list(sched.node2pending[node2]) == sent2
+        assert list(sched.pending) == list(range(4, 20))
+        sched.remove_item(node1, sent1[0])
+        assert len(node1.sent) == 4
+        assert list(sched.pending) == list(range(6, 20))
         for node in (node1, node2):
-            for i in range(sched.ITEM_CHUNKSIZE):
-                sched.remove_item(node, "xyz")
+            while sched.node2pending[node]:
+                sched.remove_item(node, sched.node2pending[node][0])
         assert not sched.pending
+        assert sched.tests_finished()
+
+    def test_remove_item_out_of_order(self):
+        sched = LoadScheduling(1)
+        node = MockNode()
+        sched.addnode(node)
+        col = ["xyz%d" % i for i in range(4)]
+        sched.addnode_collection(node, col)
+        sched.init_distribute()
+        assert sched.collection == col
+        assert node.sent == [0, 1]
+        sched.remove_item(node, 1)
+        assert list(sched.node2pending[node]) == [0, 2, 3]
+        py.test.raises(ValueError, 'sched.remove_item(node, 1)')
+
+    def test_batches_shrink(self):
+        sched = LoadScheduling(2)
+        node1 = MockNode()
+        node2 = MockNode()
+        sched.addnode(node1)
+        sched.addnode(node2)
+        col = ["xyz%d" % i for i in range(1000)]
+        sched.addnode_collection(node1, col)
+        sched.addnode_collection(node2, col)
+        sched.init_distribute()
+        assert len(node1.sent) == 125
+        sizes = []
+        while sched.node2pending[node1]:
+            before = len(node1.sent)
+            sched.remove_item(node1, sched.node2pending[node1][0])
+            if len(node1.sent) > before:
+                sizes.append(len(node1.sent) - before)
+        assert sizes
+        assert sizes == sorted(sizes, reverse=True)
+        assert sizes[-1] <= sched.MIN_PENDING
+
+    def test_batchsize_limited_by_throughput(self):
+        sched = LoadScheduling(1)
+        node = MockNode()
+        sched.addnode(node)
+        sched.addnode_collection(node, ["xyz%d" % i for i in range(100)])
+        sched.init_distribute()
+        assert len(node.sent) == 25
+        sched.throughput = lambda node: 2.0 # items per second
+        assert sched.batchsize(node) == 2 * sched.MAX_BATCH_SECONDS
 
     def test_add_remove_node(self):
         node = MockNode()
@@ -147,6 +315,522 @@ class TestLoadScheduling:
         crashitem = sched.remove_node(node)
         assert crashitem == collection[0]
 
+    def test_replacement_gets_enough_items(self):
+        sched = LoadScheduling(2)
+        node1 = MockNode()
+        node2 = MockNode()
+        sched.addnode(node1)
+        sched.addnode(node2)
+        col = ["xyz%d" % i for i in range(4)]
+        sched.addnode_collection(node1, col)
+        sched.addnode_collection(node2, col)
+        for node in (node1, node2):
+            sched.shutdown_node(node)
+        sched.remove_node(node2, crashed=False)
+        for item in node1.sent:
+            sched.remove_item(node1, item)
+        sched.remove_node(node1)
+        node3 = MockNode()
+        sched.addnode(node3)
+        sched.addnode_collection(node3, col)
+        # a slave only starts running once it got two items
+        assert node3.sent == node2.sent
+
+    def test_replacement_node(self):
+        sched = LoadScheduling(2)
+        node1 = MockNode()
+        node2 = MockNode()
+        sched.addnode(node1)
+        sched.addnode(node2)
+        col = ["xyz%d" % i for i in range(20)]
+        sched.addnode_collection(node1, col)
+        sched.addnode_collection(node2, col)
+        crashitem = sched.remove_node(node1)
+        assert crashitem == col[node1.sent[0]]
+        assert node1.sent[1] in sched.pending
+        node3 = MockNode()
+        sched.addnode(node3)
+        sched.addnode_collection(node3, col)
+        assert node3.sent
+        for node in (node2, node3):
+            while sched.node2pending[node]:
+                sched.remove_item(node, sched.node2pending[node][0])
+        assert sched.tests_finished()
+        assert sorted(node2.sent + node3.sent) == \
+            sorted(set(range(20)) - set([node1.sent[0]]))
+
+    def test_retire_node(self):
+        sched = LoadScheduling(2)
+        node1 = MockNode()
+        node2 = MockNode()
+        sched.addnode(node1)
+        sched.addnode(node2)
+        col = ["xyz%d" % i for i in range(20)]
+        sched.addnode_collection(node1, col)
+        sched.addnode_collection(node2, col)
+        sent = list(node1.sent)
+        assert sched.retire_node(node1)
+        assert node1.steal_requests == [sent[1:]]
+        sched.remove_stolen(node1, sent[1:])
+        assert list(sched.node2pending[node1]) == sent[:1]
+        sched.remove_item(node1, sent[0])
+        assert node1.sent == sent
+        assert not sched.remove_node(node1)
+        assert sent[1] in node2.sent + list(sched.pending)
+
+    def setup_stealing(self):
+        sched = LoadScheduling(2)
+        sched.BATCH_DIVISOR = 1
+        node1 = MockNode()
+        node2 = MockNode()
+        sched.addnode(node1)
+        sched.addnode(node2)
+        col = ["a::test_%d" % i for i in range(12)]
+        sched.batchsize = lambda node: 6
+        sched.addnode_collection(node1, col)
+        sched.addnode_collection(node2, col)
+        sched.init_distribute()
+        del sched.batchsize
+        assert not sched.pending
+        assert len(node1.sent) == len(node2.sent) == 6
+        return sched, node1, node2
+
+    def test_steal_when_node_runs_dry(self):
+        sched, node1, node2 = self.setup_stealing()
+        for item in list(node1.sent[:5]):
+            sched.remove_item(node1, item)
+        assert not node1.steal_requests
+        assert node2.steal_requests == [node2.sent[3:]]
+        assert sched.stealing is node2
+        assert not sched.tests_finished()
+        stolen = node2.sent[3:]
+        sched.remove_stolen(node2, stolen)
+        assert sched.stealing is None
+        assert list(sched.node2pending[node2]) == node2.sent[:3]
+        assert node1.sent[6:] == stolen[:2]
+        assert list(sched.node2pending[node1]) == node1.sent[5:]
+        assert list(sched.pending) == stolen[2:]
+
+    def test_steal_partially_started(self):
+        sched, node1, node2 = self.setup_stealing()
+        for item in list(node1.sent[:5]):
+            sched.remove_item(node1, item)
+        requested = node2.steal_requests[0]
+        # the slave already started the first requested item
+        sched.remove_item(node2, node2.sent[0])
+        sched.remove_stolen(node2, requested[1:])
+        assert list(sched.node2pending[node2]) == node2.sent[1:4]
+        assert node1.sent[6:] == requested[1:]
+
+    def test_no_steal_from_nearly_done_node(self):
+        sched, node1, node2 = self.setup_stealing()
+        for item in list(node2.sent[:4]):
+            sched.remove_item(node2, item)
+        for item in list(node1.sent[:6]):
+            sched.remove_item(node1, item)
+        assert not node2.steal_requests
+        assert sched.tests_finished()
+
+    def test_stealing_node_goes_down(self):
+        sched, node1, node2 = self.setup_stealing()
+        for item in list(node1.sent[:5]):
+            sched.remove_item(node1, item)
+        assert sched.stealing is node2
+        crashitem = sched.remove_node(node2)
+        assert crashitem == sched.collection[node2.sent[0]]
+        assert sched.stealing is None
+        sched.remove_stolen(node2, node2.sent[3:])
+        # the left items are handed out to the remaining node
+        assert node1.sent[6:]
+        assert node1.sent[6:] + list(sched.pending) == node2.sent[1:]
+
+    def test_no_items_for_shutdown_nodes(self):
+        sched = LoadScheduling(2)
+        node1 = MockNode()
+        node2 = MockNode()
+        sched.addnode(node1)
+        sched.addnode(node2)
+        col = ["a::test_%d" % i for i in range(4)]
+        sched.batchsize = lambda node: 2
+        sched.addnode_collection(node1, col)
+        sched.addnode_collection(node2, col)
+        assert sched.tests_finished()
+        assert sched.shutdown_node(node1)
+        assert sched.shutdown_node(node2)
+        assert not sched.shutdown_node(node2)
+        for item in node2.sent:
+            sched.remove_item(node2, item)
+        assert sched.remove_node(node1) == col[node1.sent[0]]
+        assert len(node2.sent) == 2
+        assert not sched.tests_finished()
+        assert sched.remove_unrunnable() == [col[node1.sent[1]]]
+        assert sched.tests_finished()
+
+    def test_remove_finished_node_with_items(self):
+        sched = LoadScheduling(2)
+        node1 = MockNode()
+        node2 = MockNode()
+        sched.addnode(node1)
+        sched.addnode(node2)
+        col = ["a::test_%d" % i for i in range(4)]
+        sched.batchsize = lambda node: 2
+        sched.addnode_collection(node1, col)
+        sched.addnode_collection(node2, col)
+        assert sched.remove_node(node1, crashed=False) is None
+        assert list(sched.pending) == node1.sent
+        assert sched.remove_unrunnable() == []
+        for item in list(node2.sent):
+            sched.remove_item(node2, item)
+        assert node2.sent[2:] == node1.sent
+
+
+class TestLoadTimeScheduling:
+    def test_longest_first(self):
+        node1 = MockNode()
+        node2 = MockNode()
+        durations = {"a::fast": 0.1, "a::slow": 10.0, "a::medium": 1.0}
+        sched = LoadTimeScheduling(2, durations)
+        sched.addnode(node1)
+        sched.addnode(node2)
+        sched.MIN_PENDING = 1
+        collection = ["a::fast", "a::medium", "a::slow"]
+        sched.addnode_collection(node1, collection)
+        sched.addnode_collection(node2, collection)
+        sched.init_distribute()
+        sent = item_ids(sched, node1.sent + node2.sent)
+        assert sorted(sent) == ["a::medium", "a::slow"]
+        assert item_ids(sched, sched.pending) == ["a::fast"]
+
+    def test_unknown_items_first_in_collection_order(self):
+        node = MockNode()
+        sched = LoadTimeScheduling(1, {"a::known": 5.0})
+        sched.addnode(node)
+        collection = ["a::new1", "a::known", "a::new2"]
+        sched.addnode_collection(node, collection)
+        sched.init_distribute()
+        order = item_ids(sched, node.sent + list(sched.pending))
+        assert order == ["a::new1", "a::new2", "a::known"]
+
+    def test_no_durations_keeps_collection_order(self):
+        node = MockNode()
+        sched = LoadTimeScheduling(1, {})
+        sched.addnode(node)
+        collection = ["a::test_%d" % i for i in range(5)]
+        sched.addnode_collection(node, collection)
+        sched.init_distribute()
+        assert item_ids(sched, node.sent + list(sched.pending)) == collection
+
+
+class TestLoadScopeScheduling:
+    def test_split_scope(self):
+        scope = LoadScopeScheduling(1)
+        assert scope._split_scope("a.py::test_1") == "a.py"
+        assert scope._split_scope("a.py::test_1[x]") == "a.py"
+        assert scope._split_scope("a.py::T::()::test_1") == "a.py::T::()"
+        file = LoadFileScheduling(1)
+        assert file._split_scope("a.py::test_1") == "a.py"
+        assert file._split_scope("a.py::T::()::test_1") == "a.py"
+
+    def test_groups_kept_together(self):
+        node = MockNode()
+        sched = LoadScopeScheduling(1)
+        sched.addnode(node)
+        collection = ["a.py::A::()::test_1", "a.py::B::()::test_1",
+                      "a.py::A::()::test_2", "a.py::B::()::test_2"]
+        sched.addnode_collection(node, collection)
+        order = node.sent + list(sched.pending)
+        assert order == [0, 2, 1, 3]
+
+    def test_whole_groups_sent(self):
+        sched = LoadFileScheduling(2)
+        node1 = MockNode()
+        node2 = MockNode()
+        sched.addnode(node1)
+        sched.addnode(node2)
+        col = ["a.py::test_%d" % i for i in range(6)]
+        col += ["b.py::test_%d" % i for i in range(6)]
+        sched.addnode_collection(node1, col)
+        sched.addnode_collection(node2, col)
+        assert node1.sent == [0, 1, 2, 3, 4, 5]
+        assert node2.sent == [6, 7, 8, 9, 10, 11]
+        assert not sched.pending
+
+    def test_steal_whole_groups(self):
+        sched = LoadFileScheduling(2)
+        sched.BATCH_DIVISOR = 1
+        node1 = MockNode()
+        node2 = MockNode()
+        sched.addnode(node1)
+        sched.addnode(node2)
+        col = ["m%d.py::test_%d" % (i // 2, i % 2) for i in range(12)]
+        sched.addnode_collection(node1, col)
+        sched.addnode_collection(node2, col)
+        assert node1.sent == [0, 1, 2, 3, 4, 5]
+        assert node2.sent == [6, 7, 8, 9]
+        while len(sched.node2pending[node2]) > 1:
+            sched.remove_item(node2, sched.node2pending[node2][0])
+        assert node2.sent[4:] == [10, 11]
+        # item 3 shares its module with item 2 which is kept
+        assert node1.steal_requests == [[4, 5]]
+        sched.remove_stolen(node1, [4, 5])
+        assert list(sched.node2pending[node1]) == [0, 1, 2, 3]
+        assert node2.sent[6:] == [4, 5]
+
+
+class TestTimingStore:
+    def test_load_missing(self, tmpdir):
+        store = TimingStore(tmpdir.join("timings"))
+        assert store.load() == {}
+
+    def test_save_load(self, tmpdir):
+        path = tmpdir.join("timings")
+        store = TimingStore(path)
+        store.load()
+        store.add("a::test_1", 0.5)
+        store.add("a::test_1", 1.0)
+        store.add("a::test_2", 2.0)
+        store.save()
+        durations = TimingStore(path).load()
+        assert durations == {"a::test_1": 1.5, "a::test_2": 2.0}
+
+    def test_save_keeps_unmeasured(self, tmpdir):
+        path = tmpdir.join("timings")
+        path.write('{"a::old": 3.0}')
+        store = TimingStore(path)
+        store.load()
+        store.add("a::new", 1.0)
+        store.save()
+        assert TimingStore(path).load() == {"a::old": 3.0, "a::new": 1.0}
+
+    def test_corrupt_file(self, tmpdir):
+        path = tmpdir.join("timings")
+        path.write("{garbage")
+        assert TimingStore(path).load() == {}
+
+
+class TestDSession:
+    def setup_dsession(self, testdir, numnodes):
+        dsession = DSession(testdir.parseconfig())
+        dsession.sched = LoadScheduling(numnodes)
+        dsession.nodemanager = MockNodeManager()
+        dsession.maxslaverestart = 2
+        dsession.maxslavetests = None
+        dsession.maxslaverss = None
+        dsession.shouldstop = False
+        dsession.session_finished = False
+        dsession.config.hook.pytest_testnodedown = lambda **kwargs: None
+        dsession.config.hook.pytest_testnodeready = lambda **kwargs: None
+        nodes = [MockNode() for i in range(numnodes)]
+        for node in nodes:
+            dsession.sched.addnode(node)
+        return dsession, nodes
+
+    def test_full_list_only_from_first_node(self, testdir):
+        dsession, (node1, node2, node3) = self.setup_dsession(testdir, 3)
+        ids = ["a.py::test_%d" % i for i in range(10)]
+        dsession.slave_collectionfinish(node2, "digest", len(ids))
+        dsession.slave_collectionfinish(node1, "digest", len(ids))
+        assert node2.collection_requests == 1
+        assert node1.collection_requests == 0
+        dsession.slave_collection(node2, ids)
+        dsession.slave_collectionfinish(node3, "digest", len(ids))
+        assert dsession.sched.collection_is_completed
+        assert not node1.collection_requests
+        assert not node3.collection_requests
+        assert node1.collection is node2.collection is node3.collection
+        assert node1.sent and node2.sent and node3.sent
+
+    def test_mismatching_node_sends_full_list(self, testdir):
+        dsession, (node1, node2) = self.setup_dsession(testdir, 2)
+        dsession.slave_collectionfinish(node1, "digest1", 2)
+        dsession.slave_collectionfinish(node2, "digest2", 2)
+        dsession.slave_collection(node1, ["a.py::test_1", "a.py::test_2"])
+        assert node2.collection_requests == 1
+        py.test.raises(AssertionError, lambda:
+            dsession.slave_collection(node2, ["a.py::test_1", "a.py::test_3"]))
+
+    def test_first_node_down_before_sending(self, testdir):
+        dsession, (node1, node2) = self.setup_dsession(testdir, 2)
+        dsession.slave_collectionfinish(node1, "digest", 1)
+        dsession.slave_collectionfinish(node2, "digest", 1)
+        dsession.slave_errordown(node1, "crashed")
+        assert node2.collection_requests == 1
+        dsession.slave_collection(node2, ["a.py::test_1"])
+        assert node2.collection == ["a.py::test_1"]
+        assert dsession.sched.node2collection[node2] is node2.collection
+
+    def test_replace_node(self, testdir):
+        dsession, (node1, node2) = self.setup_dsession(testdir, 2)
+        dsession.slave_errordown(node1, "crashed")
+        process_started(dsession)
+        assert dsession.nodemanager.started == [node1.gateway.spec]
+        assert not dsession.shouldstop
+        dsession.slave_errordown(node2, "crashed")
+        process_started(dsession)
+        assert len(dsession.nodemanager.started) == 2
+        dsession.slave_errordown(MockNode(), "crashed")
+        assert len(dsession.nodemanager.started) == 2
+        assert "maximum slave restart" in dsession.shouldstop
+
+    def test_replacement_when_shutting_down(self, testdir):
+        dsession, (node1, node2) = self.setup_dsession(testdir, 2)
+        dsession.shuttingdown = True
+        dsession.slave_errordown(node1, "crashed")
+        process_started(dsession)
+        assert dsession.nodemanager.started == [node1.gateway.spec]
+        assert not dsession.shuttingdown
+
+    def setup_shutdown(self, testdir):
+        """ two nodes with two items each which were told to shut down. """
+        dsession, (node1, node2) = self.setup_dsession(testdir, 2)
+        ids = ["a.py::test_%d" % i for i in range(4)]
+        dsession.sched.batchsize = lambda node: 2
+        for node in (node1, node2):
+            dsession.add_collection(node, ids)
+        dsession.triggershutdown()
+        assert node1._shutdown and node2._shutdown
+        for item in node2.sent:
+            dsession.sched.remove_item(node2, item)
+        return dsession, node1, node2
+
+    def test_crash_during_shutdown(self, testdir):
+        dsession, node1, node2 = self.setup_shutdown(testdir)
+        dsession.config.hook.pytest_runtest_logreport = lambda report: None
+        dsession.slave_errordown(node1, "crashed")
+        # node2 left its run loop, a replacement runs the left item
+        assert len(node2.sent) == 2
+        assert not dsession.shuttingdown
+        dsession.slave_slavefinished(node2)
+        assert not dsession.session_finished
+        process_started(dsession)
+        node3, = dsession.nodemanager.nodes
+        assert dsession._booting == set([node3])
+        dsession.slave_slaveready(node3, {"version": "x"})
+        dsession.add_collection(node3, node1.collection)
+        assert node3.sent == node1.sent[1:]
+        dsession.sched.remove_item(node3, node3.sent[0])
+        assert dsession.sched.tests_finished()
+        dsession.triggershutdown()
+        assert node3._shutdown
+        dsession.slave_slavefinished(node3)
+        assert dsession.session_finished
+
+    def test_replacement_fails(self, testdir):
+        dsession, node1, node2 = self.setup_shutdown(testdir)
+        reports = []
+        dsession.config.hook.pytest_runtest_logreport = \
+            lambda report: reports.append(report)
+        dsession.nodemanager.error = execnet.HostNotFound("down")
+        dsession.slave_errordown(node1, "crashed")
+        process_started(dsession)
+        # the item node1 crashed on and the one no node was left to run
+        assert [rep.nodeid for rep in reports] == \
+            item_ids(dsession.sched, node1.sent)
+        assert "No slave was left" in str(reports[1].longrepr)
+        assert dsession.sched.tests_finished()
+        dsession.triggershutdown()
+        dsession.slave_slavefinished(node2)
+        assert dsession.session_finished
+
+    def test_finish_waits_for_replacement(self, testdir):
+        dsession, node1, node2 = self.setup_shutdown(testdir)
+        dsession.shuttingdown = False
+        dsession.start_node(node1.gateway.spec)
+        process_started(dsession)
+        node3, = dsession.nodemanager.nodes
+        for item in node1.sent:
+            dsession.sched.remove_item(node1, item)
+        dsession.triggershutdown()
+        for node in (node1, node2):
+            dsession.slave_slavefinished(node)
+        assert not dsession.session_finished
+        dsession.slave_slaveready(node3, {"version": "x"})
+        assert node3._shutdown
+        dsession.slave_slavefinished(node3)
+        assert dsession.session_finished
+
+    def test_recycle_after_tests(self, testdir):
+        dsession, (node1, node2) = self.setup_dsession(testdir, 2)
+        dsession.maxslavetests = 2
+        dsession._check_recycle(node1, None)
+        assert not dsession._starting
+        dsession._check_recycle(node1, None)
+        process_started(dsession)
+        assert dsession.nodemanager.started == [node1.gateway.spec]
+        assert node1._shutdown
+        assert node1 in dsession.sched.retiring
+        node3, = dsession.nodemanager.nodes
+        assert dsession._booting == set([node3])
+        dsession._check_recycle(node1, None)
+        assert not dsession._starting
+        assert len(dsession.nodemanager.started) == 1
+
+    def test_recycle_replacement_fails(self, testdir):
+        dsession, (node1, node2) = self.setup_dsession(testdir, 2)
+        ids = ["a.py::test_%d" % i for i in range(8)]
+        dsession.sched.batchsize = lambda node: 4
+        for node in (node1, node2):
+            dsession.add_collection(node, ids)
+        dsession.maxslavetests = 1
+        dsession.nodemanager.error = execnet.HostNotFound("down")
+        dsession.sched.remove_item(node1, node1.sent[0])
+        dsession._check_recycle(node1, None)
+        process_started(dsession)
+        assert not dsession.shouldstop
+        assert not dsession.nodemanager.nodes
+        # the retired node gives back its items and node2 runs them
+        dsession.slave_stolen(node1, node1.sent[2:])
+        for item in list(node2.sent):
+            dsession.sched.remove_item(node2, item)
+        assert node2.sent[4:] == node1.sent[2:]
+
+    def test_recycle_after_rss(self, testdir):
+        dsession, (node1, node2) = self.setup_dsession(testdir, 2)
+        dsession.maxslaverss = 100
+        dsession._check_recycle(node1, 50 * 1024 * 1024)
+        dsession._check_recycle(node1, None)
+        assert not dsession._starting
+        dsession._check_recycle(node1, 200 * 1024 * 1024)
+        process_started(dsession)
+        assert dsession.nodemanager.started == [node1.gateway.spec]
+
+    def test_no_recycle_with_each(self, testdir):
+        dsession, (node1, node2) = self.setup_dsession(testdir, 2)
+        dsession.sched = EachScheduling(2)
+        dsession.maxslavetests = 1
+        dsession._check_recycle(node1, None)
+        assert not dsession._starting
+
+    def test_no_replacement_when_finished(self, testdir):
+        dsession, (node1, node2) = self.setup_dsession(testdir, 2)
+        dsession.shuttingdown = True
+        dsession.sched.tests_finished = lambda: True
+        dsession.slave_errordown(node1, "crashed")
+        assert not dsession.nodemanager.started
+        assert not dsession.session_finished
+        dsession.slave_errordown(node2, "crashed")
+        assert dsession.session_finished
+
+
+class TestEventQueue:
+    def test_getall(self):
+        q = EventQueue()
+        q.put(1)
+        q.put(2)
+        assert q.getall(timeout=0.1) == [1, 2]
+        assert q.getall(timeout=0.01) == []
+        q.put(3)
+        assert q.getall(timeout=0.1) == [3]
+
+    def test_wakes_up_on_put(self):
+        q = EventQueue()
+        t = py.std.threading.Timer(0.05, lambda: q.put(1))
+        t.start()
+        start = py.std.time.time()
+        assert q.getall(timeout=10.0) == [1]
+        assert py.std.time.time() - start < 5.0
+        t.join()
+
 
 class TestDistReporter:
 
@@ -1,6 +1,8 @@
 import py
+import os
 from xdist.looponfail import RemoteControl
 from xdist.looponfail import StatRecorder
+from xdist.looponfail import InotifyRecorder, makerecorder
 
 class TestStatRecorder:
     def test_filechange(self, tmpdir):
@@ -74,6 +76,27 @@ class TestStatRecorder:
         changed = sd.check()
         assert changed
 
+    def test_listing_reused(self, tmpdir, monkeypatch):
+        hello = tmpdir.ensure("sub", "hello.py")
+        for p in (tmpdir, tmpdir.join("sub")):
+            p.setmtime(p.mtime() - 10)
+        sd = StatRecorder([tmpdir])
+        listed = []
+        def listdir(path, listdir=os.listdir):
+            listed.append(path)
+            return listdir(path)
+        monkeypatch.setattr(os, "listdir", listdir)
+        assert not sd.check()
+        assert not listed
+        # modifying a file does not change its directory's mtime
+        hello.write("world")
+        hello.setmtime(hello.mtime() + 10)
+        assert sd.check()
+        assert not listed
+        tmpdir.ensure("sub", "new.py")
+        assert sd.check()
+        assert listed == [str(tmpdir.join("sub"))]
+
     def test_waitonchange(self, tmpdir, monkeypatch):
         tmp = tmpdir
         sd = StatRecorder([tmp])
@@ -83,6 +106,67 @@ class TestStatRecorder:
         sd.waitonchange(checkinterval=0.2)
         assert not l
 
+def pytest_funcarg__inotify(request):
+    tmp = request.getfuncargvalue("tmpdir")
+    tmp.ensure("hello.py")
+    tmp.ensure("sub", "sub.py")
+    try:
+        sd = InotifyRecorder([tmp])
+    except (ImportError, AttributeError, EnvironmentError):
+        py.test.skip("inotify not available")
+    request.addfinalizer(sd.close)
+    return sd
+
+def readchanges(sd):
+    l = []
+    while sd.select(0.2):
+        l.extend(sd.readchanges())
+    return l
+
+class TestInotifyRecorder:
+    def test_filechange(self, tmpdir, inotify):
+        sd = inotify
+        assert not readchanges(sd)
+        tmpdir.join("hello.py").write("world")
+        tmpdir.join("sub", "sub.py").write("world")
+        assert set(readchanges(sd)) == set([tmpdir.join("hello.py"),
+                                           tmpdir.join("sub", "sub.py")])
+        tmpdir.join("sub", "sub.py").remove()
+        assert readchanges(sd) == [tmpdir.join("sub", "sub.py")]
+
+    def test_ignored(self, tmpdir, inotify):
+        sd = inotify
+        tmpdir.join(".hello.py.swp").write("x")
+        tmpdir.join("hello.pyc").write("x")
+        tmpdir.ensure("__pycache__", "hello.pyc")
+        assert not readchanges(sd)
+
+    def test_newdir(self, tmpdir, inotify):
+        sd = inotify
+        new = tmpdir.mkdir("new")
+        assert readchanges(sd) == [new]
+        new.join("new.py").write("x")
+        assert new.join("new.py") in readchanges(sd)
+
+    def test_waitonchange(self, tmpdir, inotify):
+        sd = inotify
+        def change():
+            for i in range(3):
+                tmpdir.join("hello.py").write(str(i))
+                tmpdir.join("hello.pyc").write(str(i))
+        py.std.threading.Timer(0.1, change).start()
+        sd.waitonchange()
+        # the burst of changes was consumed by a single wait
+        assert not readchanges(sd)
+        assert not tmpdir.join("hello.pyc").check()
+
+def test_makerecorder(tmpdir, monkeypatch):
+    import xdist.looponfail
+    def fail(rootdirlist):
+        raise OSError(28, "no space left on device")
+    monkeypatch.setattr(xdist.looponfail, "InotifyRecorder", fail)
+    assert isinstance(makerecorder([tmpdir]), StatRecorder)
+
 class TestRemoteControl:
     def test_nofailures(self, testdir):
         item = testdir.getitem("def test_func(): pass\n")
@@ -139,6 +223,177 @@ class TestRemoteControl:
         control.loop_once()
         assert control.failures
 
+class TestSelection:
+    def test_selecttests(self, testdir):
+        config = testdir.parseconfig()
+        control = RemoteControl(config)
+        helper = str(testdir.tmpdir.join("helper.py"))
+        test_a = str(testdir.tmpdir.join("test_a.py"))
+        assert control.selecttests([helper]) is None
+        control.recorddeps({"test_a.py::test_a": [test_a, helper],
+                            "test_b.py::test_b": [str(testdir.tmpdir.join(
+                                                       "test_b.py"))]},
+                           {test_a: "test_a.py"}, True)
+        control.failures = ["test_b.py::test_b", "test_c.py"]
+        assert control.selecttests([helper]) == ["test_c.py",
+                                                 "test_a.py::test_a"]
+        assert control.selecttests([test_a, test_a + "c"]) == [
+            "test_c.py", "test_a.py", "test_a.py::test_a"]
+        assert control.selecttests([helper, None]) is None
+        assert control.selecttests([helper, "data.txt"]) is None
+        assert control.selecttests(["new.py"]) is None
+
+    def test_rerun_affected(self, testdir):
+        runs = testdir.tmpdir.join("runs")
+        helper = testdir.makepyfile(helper="""
+            def value():
+                return 0
+        """)
+        testdir.makepyfile(test_a="""
+            import helper
+            def test_a():
+                assert helper.value() == 1
+        """, test_b="""
+            def test_b():
+                open(%r, "a").write("b")
+                assert 0
+        """ % str(runs))
+        config = testdir.parseconfigure(testdir.tmpdir)
+        control = RemoteControl(config)
+        control.loop_once()
+        assert len(control.failures) == 2
+        assert str(helper.realpath()) in control.deps["test_a.py::test_a"]
+        helper.write(py.code.Source("""
+            def value():
+                return 1
+        """))
+        removepyc(helper)
+        control.loop_once([helper])
+        assert control.selected
+        assert control.failures == ["test_b.py::test_b"]
+        assert runs.read() == "b"
+
+class TestDistributed:
+    def test_rerun_failures(self, testdir):
+        runs = testdir.tmpdir.join("runs")
+        p = testdir.makepyfile("""
+            def test_one():
+                open(%r, "a").write("1")
+                assert 0
+            def test_two():
+                open(%r, "a").write("2")
+        """ % (str(runs), str(runs)))
+        config = testdir.parseconfigure("-n2", p)
+        control = RemoteControl(config)
+        control.loop_once()
+        assert sorted(runs.read()) == ["1", "2"]
+        assert control.failures == ["test_rerun_failures.py::test_one"]
+        assert str(p.realpath()) in control.deps[control.failures[0]]
+        assert control.modules[str(p.realpath())] == p.basename
+        control.loop_once()
+        assert sorted(runs.read()) == ["1", "1", "2"]
+        assert control.failures == ["test_rerun_failures.py::test_one"]
+        control.loop_once([p])
+        assert sorted(runs.read()) == ["1", "1", "1", "2", "2"]
+
+class TestZygote:
+    def test_forked_sessions_preload(self, testdir):
+        if not hasattr(os, "fork"):
+            py.test.skip("--zygote needs fork")
+        p = testdir.makepyfile("""
+            import os, sys
+            preloaded = "xml.dom.minidom" in sys.modules
+            import xml.dom.minidom
+            def test_preloaded():
+                assert preloaded
+            def test_ppid():
+                assert os.getppid() == %d
+        """ % os.getpid())
+        config = testdir.parseconfigure("--zygote", p)
+        control = RemoteControl(config)
+        try:
+            control.loop_once()
+            assert len(control.failures) == 2
+            assert "xml.dom.minidom" in control.preload
+            assert p.purebasename not in control.preload
+            zygotepid = control.zygote.gateway.remote_exec(
+                "import os; channel.send(os.getpid())").receive()
+            p.write(p.read().replace(str(os.getpid()), str(zygotepid)))
+            removepyc(p)
+            control.loop_once()
+            assert not control.failures
+        finally:
+            control.teardown_zygote()
+        assert control.zygote is None
+
+    def test_zygote_died(self, testdir):
+        if not hasattr(os, "fork"):
+            py.test.skip("--zygote needs fork")
+        p = testdir.makepyfile("""
+            def test_ok():
+                pass
+        """)
+        config = testdir.parseconfigure("--zygote", p)
+        control = RemoteControl(config)
+        try:
+            control.loop_once()
+            zygotepid = control.zygote.gateway.remote_exec(
+                "import os; channel.send(os.getpid())").receive()
+            os.kill(zygotepid, py.std.signal.SIGKILL)
+            # the run falls back to a popen gateway
+            control.loop_once()
+            assert not control.failures
+            assert control.zygote is None
+            control.loop_once()
+            assert control.zygote is not None
+        finally:
+            control.teardown_zygote()
+
+    def test_preload_imports_project_module(self, testdir, monkeypatch):
+        if not hasattr(os, "fork"):
+            py.test.skip("--zygote needs fork")
+        # the zygote imports helper like any module from outside the
+        # looponfailroots, i.e. from sys.path
+        path = [str(testdir.tmpdir)]
+        if os.environ.get("PYTHONPATH"):
+            path.append(os.environ["PYTHONPATH"])
+        monkeypatch.setenv("PYTHONPATH", os.pathsep.join(path))
+        testdir.makeini("""
+            [pytest]
+            looponfailroots = proj
+        """)
+        testdir.makepyfile(helper="""
+            import os, sys
+            sys.path.insert(0, os.path.join(os.path.dirname(__file__),
+                                            "proj"))
+            import projmod
+        """)
+        proj = testdir.mkdir("proj")
+        proj.join("projmod.py").write("value = 1\n")
+        p = proj.join("test_value.py")
+        p.write(py.code.Source("""
+            import helper, projmod
+            def test_value():
+                assert projmod.value == 1
+        """))
+        config = testdir.parseconfigure("--zygote", p)
+        control = RemoteControl(config)
+        try:
+            control.loop_once()
+            assert "helper" in control.preload
+            control.loop_once()
+            assert "helper" in control.unsafe
+            assert not control.zygote.gateway.remote_exec("""
+                import sys
+                channel.send("projmod" in sys.modules)
+            """).receive()
+            proj.join("projmod.py").write("value = 2\n")
+            removepyc(proj.join("projmod.py"))
+            control.loop_once()
+            assert len(control.failures) == 1
+        finally:
+            control.teardown_zygote()
+
 class TestLooponFailing:
     def test_looponfail_from_fail_to_ok(self, testdir):
         modcol = testdir.getmodulecol("""
@@ -1,4 +1,5 @@
 import py
+import os
 import execnet
 from xdist.slavemanage import NodeManager
 
@@ -22,6 +23,93 @@ def test_dist_options(testdir):
     check_options(config)
     assert config.option.dist == "load"
 
+def test_dist_options_auto(testdir, monkeypatch):
+    from xdist import plugin
+    monkeypatch.setattr(plugin, "auto_numprocesses",
+                        lambda mode, slavemb: len(mode))
+    config = testdir.parseconfigure("-n", "logical")
+    plugin.check_options(config)
+    assert config.option.tx == ['popen'] * 7
+    config = testdir.parseconfigure("-n", "0")
+    plugin.check_options(config)
+    assert config.option.dist == "no"
+    config = testdir.parseconfigure("-n", "many")
+    py.test.raises(py.test.UsageError, plugin.check_options, config)
+
+class TestAutoNumprocesses:
+    def test_modes(self, monkeypatch):
+        from xdist import plugin
+        monkeypatch.setattr(plugin, "logical_cpus", lambda: 8)
+        monkeypatch.setattr(plugin, "physical_cpus", lambda: 4)
+        monkeypatch.setattr(plugin, "available_memory", lambda: 4096)
+        monkeypatch.setattr(plugin, "cgroup_memory", lambda: None)
+        monkeypatch.setattr(os, "getloadavg", lambda: (5.8, 0, 0),
+                            raising=False)
+        assert plugin.auto_numprocesses("logical") == 8
+        assert plugin.auto_numprocesses("physical") == 4
+        # 6 of 8 cpus are busy
+        assert plugin.auto_numprocesses("auto") == 2
+        monkeypatch.setattr(os, "getloadavg", lambda: (0.2, 0, 0))
+        assert plugin.auto_numprocesses("auto") == 4
+        assert plugin.auto_numprocesses("auto", 2048) == 2
+        monkeypatch.setattr(plugin, "available_memory", lambda: 100)
+        assert plugin.auto_numprocesses("auto") == 1
+        # the cgroup allows for less memory than the host has
+        monkeypatch.setattr(plugin, "available_memory", lambda: 4096)
+        monkeypatch.setattr(plugin, "cgroup_memory", lambda: 768)
+        assert plugin.auto_numprocesses("auto") == 3
+        monkeypatch.setattr(plugin, "physical_cpus", lambda: None)
+        assert plugin.auto_numprocesses("physical") == 8
+
+    def test_cpu_quota(self, tmpdir):
+        from xdist.plugin import cpu_quota
+        assert cpu_quota(str(tmpdir)) is None
+        tmpdir.join("cpu.max").write("max 100000\n")
+        assert cpu_quota(str(tmpdir)) is None
+        tmpdir.join("cpu.max").write("250000 100000\n")
+        assert cpu_quota(str(tmpdir)) == 3
+        tmpdir.join("cpu.max").remove()
+        tmpdir.ensure("cpu", "cpu.cfs_quota_us").write("50000\n")
+        tmpdir.ensure("cpu", "cpu.cfs_period_us").write("100000\n")
+        assert cpu_quota(str(tmpdir)) == 1
+
+    def test_cgroup_memory(self, tmpdir):
+        from xdist.plugin import cgroup_memory
+        mb = 1024 * 1024
+        assert cgroup_memory(str(tmpdir)) is None
+        tmpdir.join("memory.max").write("max\n")
+        tmpdir.join("memory.current").write("%d\n" % (100 * mb))
+        assert cgroup_memory(str(tmpdir)) is None
+        tmpdir.join("memory.max").write("%d\n" % (1024 * mb))
+        assert cgroup_memory(str(tmpdir)) == 924
+        tmpdir.join("memory.max").remove()
+        tmpdir.ensure("memory", "memory.limit_in_bytes").write(
+            "%d\n" % (512 * mb))
+        tmpdir.ensure("memory", "memory.usage_in_bytes").write(
+            "%d\n" % (600 * mb))
+        assert cgroup_memory(str(tmpdir)) == 0
+
+    def test_physical_cpus(self, tmpdir):
+        from xdist.plugin import physical_cpus
+        p = tmpdir.join("cpuinfo")
+        assert physical_cpus(str(p)) is None
+        lines = []
+        for physid, coreid in [(0, 0), (0, 1), (0, 0), (0, 1), (1, 0)]:
+            lines.append("processor\t: x\nphysical id\t: %d\n"
+                         "core id\t\t: %d\n" % (physid, coreid))
+        p.write("\n".join(lines))
+        assert physical_cpus(str(p)) == 3
+
+    def test_available_memory(self, tmpdir):
+        from xdist.plugin import available_memory
+        p = tmpdir.join("meminfo")
+        assert available_memory(str(p)) is None
+        p.write("MemTotal: 8192000 kB\nMemFree: 1024000 kB\n"
+                "Buffers: 1024 kB\nCached: 1023 kB\n")
+        assert available_memory(str(p)) == 1001
+        p.write("MemFree: 1024000 kB\nMemAvailable: 2048000 kB\n")
+        assert available_memory(str(p)) == 2000
+
 class TestDistOptions:
     def test_getxspecs(self, testdir):
         config = testdir.parseconfigure("--tx=popen", "--tx", "ssh=xyz")
@@ -1,6 +1,7 @@
 import py
 from xdist.slavemanage import SlaveController, unserialize_report
-from xdist.remote import serialize_report
+from xdist.remote import serialize_report, collection_digest, Producer
+from xdist.remote import compress_message, decompress_message
 import execnet
 queue = py.builtin._tryimport("queue", "Queue")
 from py.builtin import print_
@@ -29,6 +30,9 @@ class SlaveSetup:
         self.testdir = testdir = request.getfuncargvalue("testdir")
         self.request = request
         self.events = queue.Queue()
+        self.pending = []
+        self.slaveinput = {}
+        self.compressed = 0
 
     def setup(self, ):
         self.testdir.chdir()
@@ -37,15 +41,26 @@ class SlaveSetup:
         self.config = config = self.testdir.parseconfigure()
         putevent = self.use_callback and self.events.put or None
         self.slp = SlaveController(None, self.gateway, config, putevent)
+        self.slp.slaveinput.update(self.slaveinput)
         self.request.addfinalizer(self.slp.ensure_teardown)
         self.slp.setup()
 
     def popevent(self, name=None):
         while 1:
-            if self.use_callback:
+            if self.pending:
+                data = self.pending.pop(0)
+            elif self.use_callback:
                 data = self.events.get(timeout=WAIT_TIMEOUT)
             else:
                 data = self.slp.channel.receive(timeout=WAIT_TIMEOUT)
+                if data[0] == "compressed":
+                    self.compressed += 1
+                    data = decompress_message(data[1])
+                if data[0] == "testreports" and name != "testreports":
+                    # unpack batched reports into single events
+                    self.pending.extend([("testreport", kwargs)
+                        for kwargs in data[1]['reports']])
+                    continue
             ev = EventCall(data)
             if name is None or ev.name == name:
                 return ev
@@ -54,6 +69,15 @@ class SlaveSetup:
     def sendcommand(self, name, **kwargs):
         self.slp.sendcommand(name, **kwargs)
 
+    def getcollection(self, ev=None):
+        if ev is None:
+            ev = self.popevent("collectionfinish")
+        self.sendcommand("sendcollection")
+        ids = self.popevent("collection").kwargs['ids']
+        assert ev.kwargs['count'] == len(ids)
+        assert ev.kwargs['digest'] == collection_digest(ids)
+        return ids
+
 def pytest_funcarg__slave(request):
     return SlaveSetup(request)
 
@@ -96,6 +120,32 @@ class TestReportSerialization:
             if rep.failed:
                 assert newrep.longrepr == str(rep.longrepr)
 
+    def test_itemreport_compact(self, testdir):
+        reprec = testdir.inline_runsource("""
+            import py
+            def test_pass():
+                print ("hello")
+            def test_fail(): 0/0
+            @py.test.mark.xfail
+            def test_xpass(): pass
+        """)
+        reports = reprec.getreports("pytest_runtest_logreport")
+        for rep in reports:
+            d = serialize_report(rep, compact=True)
+            check_marshallable(d)
+            if rep.passed:
+                assert "keywords" not in d
+                assert "sections" not in d
+            else:
+                assert d == serialize_report(rep)
+            newrep = unserialize_report("testreport", d)
+            assert newrep.nodeid == rep.nodeid
+            assert newrep.outcome == rep.outcome
+            assert newrep.when == rep.when
+            assert newrep.location == rep.location
+            assert newrep.duration == rep.duration
+            assert hasattr(newrep, "wasxfail") == hasattr(rep, "wasxfail")
+
     def test_collectreport_passed(self, testdir):
         reprec = testdir.inline_runsource("def test_func(): pass")
         reports = reprec.getreports("pytest_collectreport")
@@ -138,7 +188,37 @@ class TestReportSerialization:
                 assert newrep.longrepr == str(rep.longrepr)
 
 
+def unserialize_testreport(ev, ids):
+    """ unserialize a testreport event which refers to its item by index. """
+    data = ev.kwargs['data']
+    data['nodeid'] = ids[ev.kwargs['index']]
+    return unserialize_report(ev.name, data)
+
 class TestSlaveInteractor:
+    def test_looponfail_trails(self, slave):
+        p = slave.testdir.makepyfile("""
+            def test_one():
+                pass
+            def test_two():
+                pass
+        """)
+        slave.slaveinput['looponfailtrails'] = [
+            "%s::test_two" % p.basename]
+        slave.setup()
+        assert slave.getcollection() == ["%s::test_two" % p.basename]
+        slave.sendcommand("shutdown")
+
+    def test_looponfail_trails_gone(self, slave):
+        p = slave.testdir.makepyfile("""
+            def test_one():
+                pass
+        """)
+        slave.slaveinput['looponfailtrails'] = [
+            "%s::test_renamed" % p.basename]
+        slave.setup()
+        assert slave.getcollection() == ["%s::test_one" % p.basename]
+        slave.sendcommand("shutdown")
+
     def test_basic_collect_and_runtests(self, slave):
         p = slave.testdir.makepyfile("""
             def test_func():
@@ -152,14 +232,16 @@ class TestSlaveInteractor:
         assert not ev.kwargs
         ev = slave.popevent("collectionfinish")
         assert ev.kwargs['topdir'] == slave.testdir.tmpdir
-        ids = ev.kwargs['ids']
+        ids = slave.getcollection(ev)
         assert len(ids) == 1
-        slave.sendcommand("runtests", ids=ids)
+        slave.sendcommand("runtests", indices=[0])
         slave.sendcommand("shutdown")
         ev = slave.popevent("testreport") # setup
         ev = slave.popevent("testreport")
         assert ev.name == "testreport"
-        rep = unserialize_report(ev.name, ev.kwargs['data'])
+        assert ev.kwargs['index'] == 0
+        assert 'nodeid' not in ev.kwargs['data']
+        rep = unserialize_testreport(ev, ids)
         assert rep.nodeid.endswith("::test_func")
         assert rep.passed
         assert rep.when == "call"
@@ -181,7 +263,7 @@ class TestSlaveInteractor:
         rep = unserialize_report(ev.name, ev.kwargs['data'])
         assert rep.skipped
         ev = slave.popevent("collectionfinish")
-        assert not ev.kwargs['ids']
+        assert ev.kwargs['count'] == 0
 
     def test_remote_collect_fail(self, slave):
         p = slave.testdir.makepyfile("""aasd qwe""")
@@ -195,7 +277,7 @@ class TestSlaveInteractor:
         rep = unserialize_report(ev.name, ev.kwargs['data'])
         assert rep.failed
         ev = slave.popevent("collectionfinish")
-        assert not ev.kwargs['ids']
+        assert ev.kwargs['count'] == 0
 
     def test_runtests_all(self, slave):
         p = slave.testdir.makepyfile("""
@@ -208,8 +290,7 @@ class TestSlaveInteractor:
         ev = slave.popevent()
         assert ev.name == "collectionstart"
         assert not ev.kwargs
-        ev = slave.popevent("collectionfinish")
-        ids = ev.kwargs['ids']
+        ids = slave.getcollection()
         assert len(ids) == 2
         slave.sendcommand("runtests_all", )
         slave.sendcommand("shutdown", )
@@ -217,11 +298,139 @@ class TestSlaveInteractor:
             for i in range(3):  # setup/call/teardown
                 ev = slave.popevent("testreport")
                 assert ev.name == "testreport"
-                rep = unserialize_report(ev.name, ev.kwargs['data'])
+                rep = unserialize_testreport(ev, ids)
                 assert rep.nodeid.endswith(func)
         ev = slave.popevent("slavefinished")
         assert 'slaveoutput' in ev.kwargs
 
+    def test_steal(self, slave):
+        slave.testdir.makepyfile("""
+            import time
+            def test_func1():
+                time.sleep(0.5)
+            def test_func2(): pass
+            def test_func3(): pass
+        """)
+        slave.setup()
+        ids = slave.getcollection()
+        assert len(ids) == 3
+        slave.sendcommand("runtests", indices=[0, 1, 2])
+        slave.sendcommand("steal", indices=[2])
+        slave.sendcommand("shutdown")
+        reports, stolen = [], []
+        while 1:
+            ev = slave.popevent()
+            if ev.name == "slavefinished":
+                break
+            elif ev.name == "stolen":
+                stolen.append(ev.kwargs['indices'])
+            elif ev.name == "testreport":
+                reports.append(ev.kwargs['index'])
+        assert 0 in reports
+        assert 1 in reports
+        assert 2 not in reports
+        assert stolen == [[2]]
+
+    def test_reports_batched_per_test(self, slave):
+        slave.testdir.makepyfile("""
+            def test_func(): pass
+            def test_func2(): pass
+        """)
+        slave.setup()
+        ids = slave.getcollection()
+        slave.sendcommand("runtests_all")
+        slave.sendcommand("shutdown")
+        for i in range(2):
+            ev = slave.popevent("testreports")
+            reports = ev.kwargs['reports']
+            assert [r['index'] for r in reports] == [i, i, i]
+            assert [r['data']['when'] for r in reports] == \
+                   ["setup", "call", "teardown"]
+        ev = slave.popevent()
+        assert ev.name == "slavefinished"
+
+    def test_reports_batched_across_tests_if_boxed(self, slave):
+        if not hasattr(py.std.os, 'fork'):
+            py.test.skip("--boxed needs fork")
+        slave.testdir.makepyfile("""
+            def test_func(): pass
+            def test_func2(): pass
+            def test_func3(): pass
+        """)
+        slave.testdir.makeconftest("""
+            def pytest_configure(config):
+                config.option.boxed = True
+                for plugin in config.pluginmanager.getplugins():
+                    if hasattr(plugin, "REPORT_BATCH_SECONDS"):
+                        plugin.REPORT_BATCH_SECONDS = 60.0
+        """)
+        slave.setup()
+        ids = slave.getcollection()
+        slave.sendcommand("runtests_all")
+        slave.sendcommand("shutdown")
+        # the slave only flushes its reports before waiting for more
+        # work, which it does not need to before running the last test
+        ev = slave.popevent("testreports")
+        assert len(ev.kwargs['reports']) >= 6
+
+    def test_boxed_reports_not_held_by_next_test(self, slave):
+        if not hasattr(py.std.os, 'fork'):
+            py.test.skip("--boxed needs fork")
+        slave.testdir.makepyfile("""
+            import time
+            def test_func(): pass
+            def test_func2(): time.sleep(2)
+            def test_func3(): pass
+        """)
+        slave.testdir.makeconftest("""
+            def pytest_configure(config):
+                config.option.boxed = True
+                for plugin in config.pluginmanager.getplugins():
+                    if hasattr(plugin, "REPORT_BATCH_SECONDS"):
+                        plugin.REPORT_BATCH_SECONDS = 0.2
+        """)
+        slave.setup()
+        ids = slave.getcollection()
+        slave.sendcommand("runtests_all")
+        slave.sendcommand("shutdown")
+        # sent while test_func2 still runs
+        ev = slave.popevent("testreports")
+        assert [r['index'] for r in ev.kwargs['reports']] == [0, 0, 0]
+
+    def test_failing_report_sent_at_once(self, slave):
+        slave.testdir.makepyfile("""
+            def test_func():
+                assert 0
+        """)
+        slave.setup()
+        ids = slave.getcollection()
+        slave.sendcommand("runtests_all")
+        slave.sendcommand("shutdown")
+        reports = slave.popevent("testreports").kwargs['reports']
+        assert [r['data']['when'] for r in reports] == ["setup", "call"]
+        reports = slave.popevent("testreports").kwargs['reports']
+        assert [r['data']['when'] for r in reports] == ["teardown"]
+
+    def test_compressed_messages(self, slave):
+        slave.testdir.makepyfile("""
+            def test_func(): pass
+            def test_func2(): assert 0
+        """)
+        slave.slaveinput['compress'] = (1, py.std.sys.version_info[0])
+        slave.setup()
+        slave.slp.compress = 1
+        ids = slave.getcollection()
+        slave.sendcommand("runtests_all")
+        slave.sendcommand("shutdown")
+        for func in "::test_func", "::test_func2":
+            for i in range(3):
+                ev = slave.popevent("testreport")
+                rep = unserialize_testreport(ev, ids)
+                assert rep.nodeid.endswith(func)
+        assert rep.when == "teardown"
+        ev = slave.popevent("slavefinished")
+        assert slave.compressed > 5
+
     def test_happy_run_events_converted(self, testdir, slave):
         py.test.xfail("implement a simple test for event production")
         assert not slave.use_callback
@@ -244,3 +453,42 @@ class TestSlaveInteractor:
             ("pytest_collectreport", "report.collector.fspath == bbb"),
         ])
 
+def test_collection_digest():
+    ids = ["test_a.py::test_one", "test_a.py::test_two"]
+    assert collection_digest(ids) == collection_digest(list(ids))
+    assert collection_digest(ids) != collection_digest(ids[:1])
+    assert collection_digest(ids) != collection_digest(ids[::-1])
+    assert collection_digest(["a", "b"]) != collection_digest(["a\nb"])
+
+def test_compress_message():
+    message = ("testreports", {"reports": [{"data": {"longrepr": "x" * 500,
+                                                      "location": ("a", 1)}}]})
+    assert compress_message(message, 10000) is message
+    compressed = compress_message(message, 100)
+    name, kwargs = compressed
+    assert name == "compressed"
+    assert len(kwargs['data']) < 100
+    assert decompress_message(kwargs) == message
+
+def test_getrss():
+    from xdist.remote import getrss
+    rss = getrss()
+    assert rss > 1024 * 1024
+
+class TestProducer:
+    def test_disabled_does_not_format(self):
+        class Unformattable:
+            def __repr__(self):
+                raise AssertionError("formatted")
+            __str__ = __repr__
+        log = Producer("test", enabled=False)
+        log("value %s", Unformattable())
+        log.sub("value %s", Unformattable())
+
+    def test_enabled_writes(self, capsys):
+        log = Producer("test")
+        log("value %s %r", 1, "x")
+        log.sub("no args %s")
+        out, err = capsys.readouterr()
+        assert err.splitlines() == ["[test] value 1 'x'",
+                                    "[test:sub] no args %s"]
@@ -1,7 +1,7 @@
 import py
 import os
 import execnet
-from xdist.slavemanage import HostRSync, NodeManager
+from xdist.slavemanage import HostRSync, NodeManager, SlaveController, Zygote
 
 pytest_plugins = "pytester",
 
@@ -51,6 +51,21 @@ class TestNodeManagerPopen:
         hm.teardown_nodes()
         assert not len(hm.group)
 
+    def test_setup_node_new_id(self, testdir):
+        config = testdir.parseconfigure()
+        hm = NodeManager(config, ["popen"])
+        hm.makegateways()
+        spec = hm.specs[0]
+        node = hm.start_node(hm.make_node_gateway(spec), putevent=None)
+        try:
+            assert node.gateway.id == "gw1"
+            assert node.gateway.spec.popen
+            assert hm.specs == [spec, node.gateway.spec]
+            assert len(hm.group) == 2
+        finally:
+            node.shutdown()
+            hm.teardown_nodes()
+
     def test_popens_rsync(self, config, mysetup):
         source = mysetup.source
         hm = NodeManager(config, ["popen"] * 2)
@@ -98,6 +113,66 @@ class TestNodeManagerPopen:
         assert call.gateways[0] in hm.group
         call = hookrecorder.popcall("pytest_xdist_rsyncfinish")
 
+    def test_makegateways_concurrently(self, testdir, monkeypatch):
+        config = testdir.parseconfig("--setup-concurrency=2")
+        hm = NodeManager(config, ["popen"] * 5)
+        lock = py.std.threading.Lock()
+        running = []
+        maxrunning = []
+        class FakeGateway:
+            def __init__(self, spec):
+                self.spec = spec
+                self.id = spec.id
+        def makegateway(spec):
+            lock.acquire()
+            running.append(spec)
+            maxrunning.append(len(running))
+            lock.release()
+            # finish later specs first
+            py.std.time.sleep(0.05 * (5 - int(spec.id[2:])))
+            lock.acquire()
+            running.remove(spec)
+            lock.release()
+            return FakeGateway(spec)
+        monkeypatch.setattr(hm, "makegateway", makegateway)
+        gateways = hm.makegateways()
+        assert [gw.id for gw in gateways] == ["gw%d" % i for i in range(5)]
+        assert max(maxrunning) == 2
+        for gw in gateways:
+            assert gw.starttime
+
+    def test_makegateways_error(self, config, monkeypatch):
+        hm = NodeManager(config, ["popen"] * 3)
+        def makegateway(spec):
+            if spec.id == "gw1":
+                raise ValueError(spec.id)
+            return hm.group.makegateway(spec)
+        monkeypatch.setattr(hm, "makegateway", makegateway)
+        try:
+            excinfo = py.test.raises(ValueError, hm.makegateways)
+            assert str(excinfo.value) == "gw1"
+        finally:
+            hm.teardown_nodes()
+
+    def test_makegateways_error_no_wait(self, testdir, monkeypatch):
+        config = testdir.parseconfig("--setup-concurrency=3")
+        hm = NodeManager(config, ["popen"] * 3)
+        def makegateway(spec):
+            if spec.id == "gw1":
+                raise ValueError(spec.id)
+            if spec.id == "gw2":
+                py.std.time.sleep(3.0)
+                return None # never used
+            return hm.group.makegateway(spec)
+        monkeypatch.setattr(hm, "makegateway", makegateway)
+        starttime = py.std.time.time()
+        try:
+            py.test.raises(ValueError, hm.makegateways)
+            # the slow gateway is not waited for
+            assert py.std.time.time() - starttime < 2.0
+        finally:
+            hm.teardown_nodes()
+
 class TestHRSync:
     def pytest_funcarg__mysetup(self, request):
         class mysetup:
@@ -235,3 +310,195 @@ class TestNodeManager:
         assert rep.passed
 
 
+
+class TestSlaveControllerCompress:
+    class MockGateway:
+        id = "gw0"
+        def __init__(self, spec):
+            self.spec = execnet.XSpec(spec)
+
+    def test_not_compressed_by_default(self, config):
+        slave = SlaveController(None, self.MockGateway("ssh=host"),
+                                config, None)
+        assert 'compress' not in slave.slaveinput
+
+    def test_compress_threshold(self, config):
+        slave = SlaveController(None, self.MockGateway("ssh=host//compress"),
+                                config, None)
+        threshold, version = slave.slaveinput['compress']
+        assert threshold == SlaveController.COMPRESS_THRESHOLD
+        assert version == py.std.sys.version_info[0]
+        slave = SlaveController(None,
+            self.MockGateway("socket=host:8888//compress=100"), config, None)
+        assert slave.slaveinput['compress'][0] == 100
+
+    def test_popen_not_compressed(self, config):
+        slave = SlaveController(None, self.MockGateway("popen//compress"),
+                                config, None)
+        assert 'compress' not in slave.slaveinput
+
+class TestZygote:
+    def test_canfork(self):
+        assert Zygote.canfork(execnet.XSpec("popen"))
+        assert Zygote.canfork(execnet.XSpec("popen//id=gw3"))
+        assert not Zygote.canfork(execnet.XSpec("popen//python=python3"))
+        assert not Zygote.canfork(execnet.XSpec("popen//chdir=abc"))
+        assert not Zygote.canfork(execnet.XSpec("popen//env:X=1"))
+        assert not Zygote.canfork(execnet.XSpec("ssh=host"))
+
+    def test_forked_gateways(self, testdir):
+        if not hasattr(os, "fork"):
+            py.test.skip("--zygote needs fork")
+        config = testdir.parseconfigure("--zygote")
+        hm = NodeManager(config, ["popen"] * 2)
+        hm.makegateways()
+        try:
+            zygotepid = hm.zygote.gateway.remote_exec(
+                "import os; channel.send(os.getpid())").receive()
+            for gw in hm.group:
+                ppid = gw.remote_exec(
+                    "import os; channel.send(os.getppid())").receive()
+                assert ppid == zygotepid
+            gw = hm.make_node_gateway(hm.specs[0])
+            node = hm.start_node(gw, putevent=None)
+            assert node.gateway.id == "gw2"
+            node.shutdown()
+        finally:
+            hm.teardown_nodes()
+        assert not len(hm.group)
+        assert not hm.zygote.tmpdir.check()
+
+    def test_preload(self):
+        if not hasattr(os, "fork"):
+            py.test.skip("--zygote needs fork")
+        zygote = Zygote()
+        group = execnet.Group()
+        try:
+            zygote.preload(["xml.dom.minidom", "does_not_exist"])
+            spec = execnet.XSpec("popen")
+            group.allocate_id(spec)
+            gw = zygote.makegateway(group, spec)
+            assert gw.remote_exec("""
+                import sys
+                channel.send("xml.dom.minidom" in sys.modules)
+            """).receive()
+        finally:
+            group.terminate()
+            zygote.exit()
+
+    def test_preload_exiting_module(self, testdir):
+        if not hasattr(os, "fork"):
+            py.test.skip("--zygote needs fork")
+        testdir.makepyfile(exiting="raise SystemExit(1)")
+        zygote = Zygote()
+        group = execnet.Group()
+        try:
+            assert zygote.preload(["exiting", "xml.dom.minidom"]) == []
+            spec = execnet.XSpec("popen")
+            group.allocate_id(spec)
+            gw = zygote.makegateway(group, spec)
+            assert gw.remote_exec("""
+                import sys
+                channel.send("xml.dom.minidom" in sys.modules)
+            """).receive()
+        finally:
+            group.terminate()
+            zygote.exit()
+
+    def test_exit_while_collecting(self, testdir):
+        if not hasattr(os, "fork"):
+            py.test.skip("--zygote needs fork")
+        testdir.makeconftest("""
+            import time
+            def pytest_collection_modifyitems():
+                time.sleep(60)
+        """)
+        testdir.makepyfile("def test_ok(): pass")
+        config = testdir.parseconfigure("--collect-once")
+        hm = NodeManager(config, ["popen"])
+        zygote = Zygote(hm._getzygotecollect())
+        starttime = py.std.time.time()
+        zygote.exit()
+        assert py.std.time.time() - starttime < 5.0
+        assert not len(zygote.group)
+
+def pytest_funcarg__pool(request):
+    if not hasattr(os, "fork"):
+        py.test.skip("the pool needs fork")
+    path = request.getfuncargvalue("tmpdir").join("pool")
+    proc = py.std.subprocess.Popen([py.std.sys.executable, "-m",
+                                    "xdist.pool", str(path)])
+    def stop():
+        if proc.poll() is None:
+            proc.terminate()
+            proc.wait()
+    request.addfinalizer(stop)
+    for i in range(100):
+        if path.check():
+            break
+        py.std.time.sleep(0.1)
+    return path, proc
+
+class TestPool:
+    def test_spec(self, config):
+        hm = NodeManager(config, ["pool=/tmp/pool"])
+        spec = hm.specs[0]
+        assert spec.pool == "/tmp/pool"
+        assert spec.popen and not spec.chdir
+        assert not Zygote.canfork(spec)
+        assert not hm.roots
+
+    def test_pooled_gateways(self, testdir, pool):
+        path, proc = pool
+        config = testdir.parseconfigure()
+        specs = ["pool=%s//env:XDIST_POOL=1" % path] * 2
+        pids = []
+        for i in range(2):
+            hm = NodeManager(config, specs)
+            hm.makegateways()
+            try:
+                for gw in hm.group:
+                    pid, ppid, cwd, env = gw.remote_exec("""
+                        import os
+                        channel.send((os.getpid(), os.getppid(),
+                                      os.getcwd(), os.environ['XDIST_POOL']))
+                    """).receive()
+                    assert ppid == proc.pid
+                    assert cwd == os.getcwd()
+                    assert env == "1"
+                    pids.append(pid)
+            finally:
+                hm.teardown_nodes()
+        assert len(set(pids)) == 4
+        assert path.check()
+        proc.terminate()
+        proc.wait()
+        assert not path.check()
+
+    def test_private_socket(self, pool):
+        path, proc = pool
+        # neither group nor others may connect
+        mode = py.std.stat.S_IMODE(os.stat(str(path)).st_mode)
+        assert mode & int("077", 8) == 0
+
+    def test_slaves_reaped(self, config, pool):
+        if not os.path.exists("/proc/self"):
+            py.test.skip("needs /proc")
+        path, proc = pool
+        hm = NodeManager(config, ["pool=%s" % path])
+        hm.makegateways()
+        try:
+            pid = hm.group[0].remote_exec(
+                "import os; channel.send(os.getpid())").receive()
+        finally:
+            hm.teardown_nodes()
+        # the slave does not stay around as a zombie until the next run
+        for i in range(100):
+            if not os.path.exists("/proc/%d" % pid):
+                break
+            py.std.time.sleep(0.1)
+        assert not os.path.exists("/proc/%d" % pid)
+
+    def test_no_pool(self, config, tmpdir):
+        hm = NodeManager(config, ["pool=%s" % tmpdir.join("pool")])
+        py.test.raises(execnet.HostNotFound, hm.makegateways)
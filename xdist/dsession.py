@@ -1,12 +1,44 @@
 import sys
+import time
+import threading
 import difflib
+import json
+from collections import deque
+from itertools import islice
 
 import pytest
 import py
 from xdist.slavemanage import NodeManager
+from xdist.remote import Producer
 
 
-queue = py.builtin._tryimport('queue', 'Queue')
+
+class EventQueue:
+    """ events put by the receiver threads of the slaves, which the
+    main thread takes out all at once. """
+
+    def __init__(self):
+        self._events = deque()
+        self._ready = threading.Event()
+
+    def put(self, event):
+        self._events.append(event)
+        self._ready.set()
+
+    def getall(self, timeout=None):
+        """ wait for events and return all of them, the returned list is
+        empty if none arrived within the timeout. """
+        self._ready.wait(timeout)
+        # events put from now on set the flag again
+        self._ready.clear()
+        events = []
+        popleft = self._events.popleft
+        try:
+            while 1:
+                events.append(popleft())
+        except IndexError:
+            pass
+        return events
 
 
 class EachScheduling:
@@ -15,8 +47,12 @@ class EachScheduling:
         self.numnodes = numnodes
         self.node2collection = {}
         self.node2pending = {}
+        # node -> items a node which went down did not run
+        self._removed2pending = {}
+        # nodes which were told to shut down
+        self.shutdown_nodes = set()
         if log is None:
-            self.log = py.log.Producer("eachsched")
+            self.log = Producer("eachsched", enabled=False)
         else:
             self.log = log.loadsched
         self.collection_is_completed = False
@@ -30,45 +66,121 @@ class EachScheduling:
     def tests_finished(self):
         if not self.collection_is_completed:
             return False
+        if self._removed2pending:
+            return False
         return True
 
     def addnode_collection(self, node, collection):
-        assert not self.collection_is_completed
         assert self.node2collection[node] is None
-        self.node2collection[node] = list(collection)
-        self.node2pending[node] = []
-        if len(self.node2pending) >= self.numnodes:
-            self.collection_is_completed = True
+        self.node2collection[node] = collection
+        self.node2pending[node] = pending = deque()
+        if not self.collection_is_completed:
+            if len(self.node2pending) >= self.numnodes:
+                self.collection_is_completed = True
+            return
+        # a node replacing one which went down runs what that node left
+        for removed, leftover in list(self._removed2pending.items()):
+            if self.node2collection[removed] == collection:
+                del self._removed2pending[removed]
+                pending.extend(leftover)
+                node.send_runtest_some(list(leftover))
+                break
 
     def remove_item(self, node, item):
-        self.node2pending[node].remove(item)
+        pending = self.node2pending[node]
+        if pending[0] == item:
+            pending.popleft()
+        else:
+            pending.remove(item)
+
+    def shutdown_node(self, node):
+        """ note that the node was told to shut down, return False if
+        it was told already. """
+        if node in self.shutdown_nodes:
+            return False
+        self.shutdown_nodes.add(node)
+        return True
 
-    def remove_node(self, node):
+    def remove_node(self, node, crashed=True):
+        """ remove the node and return the item it crashed on if it
+        crashed.  The items it did not run are kept for a replacement. """
+        self.shutdown_nodes.discard(node)
         # KeyError if we didn't get an addnode() yet
         pending = self.node2pending.pop(node)
         if not pending:
             return
-        crashitem = pending.pop(0)
-        # XXX what about the rest of pending?
+        crashitem = None
+        if crashed:
+            crashitem = self.node2collection[node][pending.popleft()]
+        if pending:
+            # kept for a node replacing this one
+            self._removed2pending[node] = pending
         return crashitem
 
+    def remove_unrunnable(self):
+        """ forget the items left by removed nodes if no node is left
+        which may replace them and return their ids. """
+        for node, collection in self.node2collection.items():
+            if collection is None and node not in self.shutdown_nodes:
+                # may still turn out to be a replacement
+                return []
+        nodeids = []
+        for removed, leftover in self._removed2pending.items():
+            collection = self.node2collection[removed]
+            nodeids.extend([collection[index] for index in leftover])
+        self._removed2pending.clear()
+        return nodeids
+
+    def retire_node(self, node):
+        """ nodes always run the whole collection, they can not
+        hand over their items to another node. """
+        return False
+
     def init_distribute(self):
         assert self.collection_is_completed
         for node, pending in self.node2pending.items():
             node.send_runtest_all()
-            pending[:] = self.node2collection[node]
+            pending.extend(range(len(self.node2collection[node])))
 
 class LoadScheduling:
-    LOAD_THRESHOLD_NEWITEMS = 5
-    ITEM_CHUNKSIZE = 10
+    """ distribute the collected items among the nodes.
+
+    Items are referred to by their index into ``self.collection``.
+    Both the global and the per-node pending items are deques: slaves
+    run items in the order they were sent, so completed items are
+    removed from the front, while stolen items are taken from the end.
+    """
+    # nodes get new items when they have less than this many left,
+    # as a slave only runs an item once it knows the next one
+    MIN_PENDING = 2
+    # a batch holds this fraction of the items waiting per node, so
+    # batches are large in the beginning and shrink towards the end
+    BATCH_DIVISOR = 4
+    # limit batches to this many seconds of work, judging by the
+    # throughput a node achieved so far
+    MAX_BATCH_SECONDS = 2.0
+    # refill nodes before they have less than this many seconds of work
+    REFILL_SECONDS = 0.5
+    # nodes holding at least this many items may have some stolen
+    STEAL_THRESHOLD = 3
 
     def __init__(self, numnodes, log=None):
         self.numnodes = numnodes
         self.node2pending = {}
         self.node2collection = {}
-        self.pending = []
+        # node -> [number of completed items, time of first dispatch]
+        self.node2stats = {}
+        self.collection = None
+        self.collection_node = None
+        self.pending = deque()
+        # node we asked to give back items and did not yet answer
+        self.stealing = None
+        # nodes which give back their items before shutting down
+        self.retiring = set()
+        # nodes which were told to shut down and get no more items
+        self.shutdown_nodes = set()
         if log is None:
-            self.log = py.log.Producer("loadsched")
+            self.log = Producer("loadsched", enabled=False)
         else:
             self.log = log.loadsched
         self.collection_is_completed = False
@@ -77,86 +189,344 @@ class LoadScheduling:
         return bool(self.node2pending)
 
     def addnode(self, node):
-        self.node2pending[node] = []
+        self.node2pending[node] = deque()
+        self.node2stats[node] = [0, None]
 
     def tests_finished(self):
         if not self.collection_is_completed or self.pending:
             return False
-        #for items in self.node2pending.values():
-        #    if items:
-        #        return False
+        if self.stealing is not None or self.retiring:
+            return False
+        # keep nodes running while work may still be stolen from them
+        for items in self.node2pending.values():
+            if len(items) >= self.STEAL_THRESHOLD:
+                return False
         return True
 
     def addnode_collection(self, node, collection):
-        assert not self.collection_is_completed
+        """ start sending items to the node.
+
+        The first collection to arrive determines the pending items,
+        later ones are checked against it, so nodes do not have to wait
+        for the slowest node to finish collecting.  Nodes replacing
+        nodes which went down may be added at any time.
+        """
         assert node in self.node2pending
-        self.node2collection[node] = list(collection)
+        if self.collection is None:
+            self.collection = collection
+            self.collection_node = node.gateway.id
+            self.pending = deque(self.order_pending(collection))
+        else:
+            report_collection_diff(
+                self.collection,
+                collection,
+                self.collection_node,
+                node.gateway.id,
+            )
+        self.node2collection[node] = collection
         if len(self.node2collection) >= self.numnodes:
             self.collection_is_completed = True
+        self._fill(node)
+        self._check_steal()
 
     def remove_item(self, node, item):
-        if item not in self.item2nodes:
-            raise AssertionError(item, self.item2nodes)
-        nodes = self.item2nodes[item]
-        if node in nodes: # the node might have gone down already
-            nodes.remove(node)
-        #if not nodes:
-        #    del self.item2nodes[item]
         pending = self.node2pending[node]
-        pending.remove(item)
+        if pending and pending[0] == item:
+            pending.popleft()
+        else:
+            pending.remove(item)
+        self.node2stats[node][0] += 1
         # pre-load items-to-test if the node may become ready
-        if self.pending and len(pending) < self.LOAD_THRESHOLD_NEWITEMS:
-            item = self.pending.pop(0)
-            pending.append(item)
-            self.item2nodes.setdefault(item, []).append(node)
-            node.send_runtest(item)
-        self.log("items waiting for node: %d" %(len(self.pending)))
-        #self.log("item2pending still executing: %s" %(self.item2nodes,))
+        self._fill(node)
+        self.log("items waiting for node: %d", len(self.pending))
         #self.log("node2pending: %s" %(self.node2pending,))
+        self._check_steal()
+
+    def shutdown_node(self, node):
+        """ stop sending items to the node as it was told to shut down,
+        return False if it was told already. """
+        if node in self.shutdown_nodes:
+            return False
+        self.shutdown_nodes.add(node)
+        return True
 
-    def remove_node(self, node):
+    def remove_node(self, node, crashed=True):
+        """ remove the node and return the item it crashed on if it
+        crashed.  The items it did not run are handed out to other
+        nodes. """
+        self.shutdown_nodes.discard(node)
         pending = self.node2pending.pop(node)
         # KeyError if we didn't get an addnode() yet
-        for item in pending:
-            l = self.item2nodes[item]
-            l.remove(node)
-            if not l:
-                del self.item2nodes[item]
+        del self.node2stats[node]
+        self.retiring.discard(node)
+        if self.stealing is node:
+            self.stealing = None
         if not pending:
             return
-        crashitem = pending.pop(0)
+        crashitem = None
+        if crashed:
+            crashitem = self.collection[pending.popleft()]
         self.pending.extend(pending)
+        loads = sorted(self.node2pending.items(), key=lambda x: len(x[1]))
+        for othernode, otherpending in loads:
+            self._fill(othernode)
         return crashitem
 
+    def remove_unrunnable(self):
+        """ forget the pending items if all nodes were told to shut
+        down and return their ids. """
+        for node in self.node2pending:
+            if node not in self.shutdown_nodes:
+                return []
+        nodeids = [self.collection[index] for index in self.pending]
+        self.pending.clear()
+        return nodeids
+
+    def remove_stolen(self, node, items):
+        """ put items given back by a node into the pending list
+        and hand them out to nodes which ran out of work. """
+        if self.stealing is node:
+            self.stealing = None
+        pending = self.node2pending.get(node)
+        if pending is None: # the node went down meanwhile
+            return
+        # stolen items are always at the end of the pending items
+        items = set(items)
+        stolen = []
+        while pending and pending[-1] in items:
+            stolen.append(pending.pop())
+        stolen.reverse()
+        self.pending.extend(stolen)
+        self.log("node %s gave back %d items", node, len(stolen))
+        loads = sorted(self.node2pending.items(), key=lambda x: len(x[1]))
+        for node, pending in loads:
+            self._fill(node)
+        self._check_steal()
+
+    def throughput(self, node):
+        """ return the number of items per second the node completed
+        so far or None if that is not known yet. """
+        done, starttime = self.node2stats[node]
+        if not done:
+            return None
+        elapsed = time.time() - starttime
+        if elapsed <= 0:
+            return None
+        return done / elapsed
+
+    def batchsize(self, node):
+        """ return the number of items to send to the node at once. """
+        size = len(self.pending) // (self.numnodes * self.BATCH_DIVISOR)
+        rate = self.throughput(node)
+        if rate is not None:
+            size = min(size, int(rate * self.MAX_BATCH_SECONDS))
+        size = max(size, self.MIN_PENDING)
+        if self.node2stats[node][1] is None and \
+           not self.collection_is_completed:
+            # leave a share of the items to nodes still collecting, a
+            # replacement arriving later may have to run all of them
+            size = min(size, -(-len(self.pending) // self.numnodes))
+        return size
+
+    def _fill(self, node):
+        """ send a batch of items to the node if it is running low. """
+        pending = self.node2pending[node]
+        if not self.pending or node not in self.node2collection:
+            return
+        if node in self.retiring or node in self.shutdown_nodes:
+            return
+        minimum = self.MIN_PENDING
+        rate = self.throughput(node)
+        if rate is not None:
+            minimum = max(minimum, int(rate * self.REFILL_SECONDS))
+        if len(pending) >= minimum:
+            return
+        num = min(self.batchsize(node), len(self.pending))
+        self._send_items(node, self._take_pending(num))
+
+    def _take_pending(self, num):
+        """ remove and return the next num items of the pending list. """
+        popleft = self.pending.popleft
+        return [popleft() for i in range(num)]
+
+    def _send_items(self, node, items):
+        if not items:
+            return
+        stats = self.node2stats[node]
+        if stats[1] is None:
+            stats[1] = time.time()
+        self.node2pending[node].extend(items)
+        node.send_runtest_some(items)
+
+    def _check_steal(self):
+        """ if some node ran out of work, ask the most loaded node to
+        give back half of the items it has not started yet. """
+        if self.pending or self.stealing is not None:
+            return
+        loads = sorted([(node, pending)
+                        for node, pending in self.node2pending.items()
+                        if node in self.node2collection and
+                           node not in self.retiring and
+                           node not in self.shutdown_nodes],
+                       key=lambda x: len(x[1]))
+        if len(loads) < 2 or len(loads[0][1]) >= self.MIN_PENDING:
+            return
+        node, pending = loads[-1]
+        if len(pending) < self.STEAL_THRESHOLD:
+            return
+        items = self._steal_items(pending)
+        if not items:
+            return
+        self.log("asking %s to give back %d items", node, len(items))
+        self.stealing = node
+        node.send_steal(items)
+
+    def retire_node(self, node):
+        """ stop sending items to the node and ask it to give back all
+        items it did not start yet, return True. """
+        self.retiring.add(node)
+        # the first item is running or about to be run
+        items = list(islice(self.node2pending[node], 1, None))
+        if items:
+            self.log("asking retiring %s to give back %d items",
+                     node, len(items))
+            node.send_steal(items)
+        return True
+
+    def _steal_items(self, pending):
+        """ return the items to steal from the pending items of a node. """
+        # the first two items are running or about to be run
+        start = max(2, (len(pending) + 1) // 2)
+        return list(islice(pending, start, None))
+
     def init_distribute(self):
+        """ nothing to do, items are sent as the collections arrive. """
         assert self.collection_is_completed
-        assert not hasattr(self, 'item2nodes')
-        self.item2nodes = {}
-        # XXX allow nodes to have different collections
-        first_node, col = list(self.node2collection.items())[0]
-        for node, collection in self.node2collection.items():
-            report_collection_diff(
-                col,
-                collection,
-                first_node.gateway.id,
-                node.gateway.id,
-            )
 
-        self.pending = col
-        if not col:
+    def order_pending(self, collection):
+        """ return the indices of the collection in the order in which
+        they get handed out to nodes. """
+        return range(len(collection))
+
+
+class LoadTimeScheduling(LoadScheduling):
+    """ load scheduling which hands out the slowest tests first.
+
+    Durations recorded by previous runs are used to dispatch items
+    longest-first, so that a few slow tests collected late do not end
+    up as the tail of a run.  Items without a recorded duration are
+    handed out first, in collection order, as nothing bounds their
+    duration.
+    """
+
+    def __init__(self, numnodes, durations, log=None):
+        LoadScheduling.__init__(self, numnodes, log=log)
+        self.durations = durations
+
+    def order_pending(self, collection):
+        durations = self.durations
+        unknown, known = [], []
+        for index, nodeid in enumerate(collection):
+            if nodeid in durations:
+                known.append((durations[nodeid], index))
+            else:
+                unknown.append(index)
+        known.sort(key=lambda x: x[0], reverse=True)
+        return unknown + [index for duration, index in known]
+
+
+class LoadScopeScheduling(LoadScheduling):
+    """ load scheduling which keeps the items of a scope on one node.
+
+    Items are grouped by their module and class, as given by their
+    node id, and whole groups are sent to nodes and stolen from them.
+    This way module and class scoped fixtures are only set up on the
+    node running the group.
+    """
+
+    def addnode_collection(self, node, collection):
+        if self.collection is None:
+            self.index2group = self._group_indices(collection)
+        LoadScheduling.addnode_collection(self, node, collection)
+
+    def _split_scope(self, nodeid):
+        """ return the scope of the item with the given node id. """
+        return nodeid.rsplit("::", 1)[0]
+
+    def _group_indices(self, collection):
+        """ return a list mapping indices of the collection to the
+        number of their group. """
+        scope2group = {}
+        index2group = []
+        for nodeid in collection:
+            scope = self._split_scope(nodeid)
+            group = scope2group.setdefault(scope, len(scope2group))
+            index2group.append(group)
+        return index2group
+
+    def order_pending(self, collection):
+        # keep the items of a group together, in collection order
+        index2group = self.index2group
+        return sorted(range(len(collection)), key=index2group.__getitem__)
+
+    def _take_pending(self, num):
+        items = LoadScheduling._take_pending(self, num)
+        if items:
+            # complete the group of the last item
+            pending = self.pending
+            index2group = self.index2group
+            group = index2group[items[-1]]
+            while pending and index2group[pending[0]] == group:
+                items.append(pending.popleft())
+        return items
+
+    def _steal_items(self, pending):
+        items = LoadScheduling._steal_items(self, pending)
+        if items:
+            # leave the group of the last kept item to the node
+            index2group = self.index2group
+            group = index2group[pending[len(pending) - len(items) - 1]]
+            start = 0
+            while start < len(items) and index2group[items[start]] == group:
+                start += 1
+            items = items[start:]
+        return items
+
+
+class LoadFileScheduling(LoadScopeScheduling):
+    """ load scheduling which keeps the items of a module on one node. """
+
+    def _split_scope(self, nodeid):
+        return nodeid.split("::", 1)[0]
+
+
+class TimingStore:
+    """ persistent record of per-test durations, keyed by node id. """
+
+    def __init__(self, path):
+        self.path = py.path.local(path)
+        self.durations = {}
+        self._measured = {}
+
+    def load(self):
+        try:
+            self.durations = json.loads(self.path.read())
+        except (py.error.ENOENT, ValueError):
+            self.durations = {}
+        return self.durations
+
+    def add(self, nodeid, duration):
+        """ add the duration of a setup/call/teardown phase. """
+        self._measured[nodeid] = self._measured.get(nodeid, 0.0) + duration
+
+    def save(self):
+        if not self._measured:
             return
-        available = list(self.node2pending.items())
-        num_available = self.numnodes
-        max_one_round = num_available * self.ITEM_CHUNKSIZE - 1
-        for i, item in enumerate(self.pending):
-            nodeindex = i % num_available
-            node, pending = available[nodeindex]
-            node.send_runtest(item)
-            self.item2nodes.setdefault(item, []).append(node)
-            pending.append(item)
-            if i >= max_one_round:
-                break
-        del self.pending[:i + 1]
+        self.durations.update(self._measured)
+        self._measured = {}
+        tmp = self.path.new(basename=self.path.basename + ".tmp")
+        tmp.write(json.dumps(self.durations))
+        tmp.rename(self.path)
 
 
 def report_collection_diff(from_collection, to_collection, from_id, to_id):
@@ -192,14 +562,26 @@ class Interrupted(KeyboardInterrupt):
 class DSession:
     def __init__(self, config):
         self.config = config
-        self.log = py.log.Producer("dsession")
-        if not config.option.debug:
-            py.log.setconsumer(self.log._keywords, None)
+        self.log = Producer("dsession", enabled=config.option.debug)
         self.shuttingdown = False
         self.countfailures = 0
         self.maxfail = config.getvalue("maxfail")
-        self.queue = queue.Queue()
+        self.queue = EventQueue()
         self._failed_collection_errors = {}
+        self.timings = None
+        self.slaverestarts = 0
+        # replacement gateways being made and nodes not yet ready
+        self._starting = 0
+        self._booting = set()
+        self.maxslavetests = config.getvalue("maxslavetests")
+        self.maxslaverss = config.getvalue("maxslaverss")
+        self._node2testcount = {}
+        self._retired = set()
+        # the collection of the first node and its digest, other
+        # nodes with the same digest share the list instead of sending it
+        self.collection = None
+        self.collection_digest = None
+        self._collection_waiting = []
         try:
             self.terminal = config.pluginmanager.getplugin("terminalreporter")
         except KeyError:
@@ -215,6 +597,9 @@ class DSession:
     @pytest.mark.trylast
     def pytest_sessionstart(self, session):
         self.nodemanager = NodeManager(self.config)
+        self.maxslaverestart = self.config.getvalue("maxslaverestart")
+        if self.maxslaverestart is None:
+            self.maxslaverestart = 4 * len(self.nodemanager.specs)
         self.nodemanager.setup_nodes(putevent=self.queue.put)
 
     def pytest_sessionfinish(self, session):
@@ -222,6 +607,8 @@ class DSession:
         nm = getattr(self, 'nodemanager', None) # if not fully initialized
         if nm is not None:
             nm.teardown_nodes()
+        if self.timings is not None:
+            self.timings.save()
 
     def pytest_collection(self):
         # prohibit collection of test items in master process
@@ -232,6 +619,14 @@ class DSession:
         dist = self.config.getvalue("dist")
         if dist == "load":
             self.sched = LoadScheduling(numnodes, log=self.log)
+        elif dist == "loadtime":
+            self.timings = TimingStore(self.config.getvalue("timingsfile"))
+            self.sched = LoadTimeScheduling(numnodes, self.timings.load(),
+                                            log=self.log)
+        elif dist == "loadscope":
+            self.sched = LoadScopeScheduling(numnodes, log=self.log)
+        elif dist == "loadfile":
+            self.sched = LoadFileScheduling(numnodes, log=self.log)
         elif dist == "each":
             self.sched = EachScheduling(numnodes, log=self.log)
         else:
@@ -245,20 +640,20 @@ class DSession:
         return True
 
     def loop_once(self):
-        """ process one callback from one of the slaves. """
-        while 1:
-            try:
-                eventcall = self.queue.get(timeout=2.0)
+        """ process all callbacks which arrived from the slaves. """
+        # waiting returns as soon as an event is put, the timeout
+        # only keeps the main thread interruptible by KeyboardInterrupt
+        events = self.queue.getall(timeout=2.0)
+        for callname, kwargs in events:
+            assert callname, kwargs
+            method = "slave_" + callname
+            call = getattr(self, method)
+            self.log("calling method: %s(**%s)", method, kwargs)
+            call(**kwargs)
+            if self.shouldstop or self.session_finished:
+                # the remaining events are of no interest anymore
                 break
-            except queue.Empty:
-                continue
-        callname, kwargs = eventcall
-        assert callname, kwargs
-        method = "slave_" + callname
-        call = getattr(self, method)
-        self.log("calling method: %s(**%s)" % (method, kwargs))
-        call(**kwargs)
-        if self.sched.tests_finished():
+        if events and self.sched.tests_finished():
             self.triggershutdown()
 
     #
@@ -266,13 +661,14 @@ class DSession:
     #
 
     def slave_slaveready(self, node, slaveinfo):
+        self._booting.discard(node)
         node.slaveinfo = slaveinfo
         node.slaveinfo['id'] = node.gateway.id
         node.slaveinfo['spec'] = node.gateway.spec
         self.config.hook.pytest_testnodeready(node=node)
         self.sched.addnode(node)
         if self.shuttingdown:
-            node.shutdown()
+            self.shutdown_node(node)
 
     def slave_slavefinished(self, node):
         self.config.hook.pytest_testnodedown(node=node, error=None)
@@ -280,13 +676,26 @@ class DSession:
             self.shouldstop = "%s received keyboard-interrupt" % (node,)
             self.slave_errordown(node, "keyboard-interrupt")
             return
-        crashitem = self.sched.remove_node(node)
-        #assert not crashitem, (crashitem, node)
-        if self.shuttingdown and not self.sched.hasnodes():
-            self.session_finished = True
+        # nodes run all items sent before the shutdown, anything left
+        # is handed out to other nodes or to a replacement
+        leftover = bool(self.sched.node2pending.get(node))
+        self.sched.remove_node(node, crashed=False)
+        if leftover and not self.sched.tests_finished():
+            self.replace_node(node, "did not run all its tests")
+        self._check_unrunnable()
+        self._check_finished()
 
     def slave_errordown(self, node, error):
         self.config.hook.pytest_testnodedown(node=node, error=error)
+        self._booting.discard(node)
+        waiting = self._collection_waiting
+        if waiting and waiting[0][0] is node:
+            # the node went down before sending its collection
+            del waiting[0]
+            if waiting:
+                waiting[0][0].send_collection_request()
+        else:
+            self._collection_waiting = [x for x in waiting if x[0] is not node]
         try:
             crashitem = self.sched.remove_node(node)
         except KeyError:
@@ -295,15 +704,118 @@ class DSession:
             if crashitem:
                 self.handle_crashitem(crashitem, node)
                 #self.report_line("item crashed on node: %s" % crashitem)
-        if not self.sched.hasnodes():
+        if self.shouldstop:
+            if not self.sched.hasnodes():
+                self.session_finished = True
+            return
+        if self.shuttingdown and self.sched.tests_finished():
+            self._check_finished()
+            return
+        self.replace_node(node, "went down")
+
+    def replace_node(self, node, reason):
+        """ start a slave replacing the node, which left items or went
+        down, unless the maximum number of restarts is reached. """
+        # a replacement runs what the node left, even during shutdown
+        self.shuttingdown = False
+        if self.slaverestarts >= self.maxslaverestart:
+            self.shouldstop = "maximum slave restart count reached (%d)" % (
+                self.maxslaverestart,)
+            return
+        self.slaverestarts += 1
+        self.report_line("[%s] replacing slave which %s" % (
+            node.gateway.id, reason))
+        self.start_node(node.gateway.spec)
+
+    def start_node(self, spec):
+        """ start a node like the one of spec.  Its gateway is made in a
+        thread, the reports of the other nodes are processed meanwhile. """
+        self._starting += 1
+        thread = threading.Thread(target=self._makegateway, args=(spec,))
+        thread.setDaemon(True)
+        thread.start()
+
+    def _makegateway(self, spec):
+        try:
+            gateway = self.nodemanager.make_node_gateway(spec)
+        except Exception:
+            error = py.code.ExceptionInfo().exconly()
+            self.queue.put(("startfailed", {"spec": spec, "error": error}))
+        else:
+            self.queue.put(("newgateway", {"gateway": gateway}))
+
+    def slave_newgateway(self, gateway):
+        self._starting -= 1
+        if self.shouldstop or self.shuttingdown:
+            # not needed any more, the gateway exits with the others
+            self._check_finished()
+            return
+        try:
+            node = self.nodemanager.start_node(gateway, self.queue.put)
+        except Exception:
+            self._startfailed(gateway.spec, py.code.ExceptionInfo().exconly())
+        else:
+            self._booting.add(node)
+
+    def slave_startfailed(self, spec, error):
+        self._starting -= 1
+        self._startfailed(spec, error)
+
+    def _startfailed(self, spec, error):
+        """ go on with the remaining nodes if a slave could not be
+        started, e.g. because the host of a crashed one is still down. """
+        self.report_line("[%s] could not start slave: %s" % (spec.id, error))
+        self._check_unrunnable()
+        self._check_finished()
+
+    def _check_unrunnable(self):
+        """ fail the items left by nodes which went down if no node is
+        left which may run them. """
+        if self._starting or self._booting:
+            return
+        for nodeid in self.sched.remove_unrunnable():
+            self.report_failure(nodeid,
+                "No slave was left to run %r" % (nodeid,))
+
+    def _check_finished(self):
+        if self.shuttingdown and not self.sched.hasnodes() and \
+           not self._starting and not self._booting:
             self.session_finished = True
 
-    def slave_collectionfinish(self, node, ids):
-        self.sched.addnode_collection(node, ids)
+    def slave_collectionfinish(self, node, digest, count):
         if self.terminal:
-            self.trdist.setstatus(node.gateway.spec, "[%d]" %(len(ids)))
-
-        if self.sched.collection_is_completed:
+            self.trdist.setstatus(node.gateway.spec, "[%d]" %(count))
+        if self.collection is not None:
+            if digest == self.collection_digest:
+                self.add_collection(node, self.collection)
+            else:
+                # get the differing ids to report the difference
+                node.send_collection_request()
+            return
+        self._collection_waiting.append((node, digest))
+        if len(self._collection_waiting) == 1:
+            node.send_collection_request()
+
+    def slave_collection(self, node, ids):
+        if self.collection is not None:
+            # a node whose collection digest did not match
+            self.add_collection(node, ids)
+            return
+        waiting = self._collection_waiting
+        self._collection_waiting = []
+        self.collection = ids
+        self.collection_digest = dict(waiting)[node]
+        for othernode, digest in waiting:
+            if othernode is node or digest == self.collection_digest:
+                self.add_collection(othernode, ids)
+            else:
+                othernode.send_collection_request()
+
+    def add_collection(self, node, ids):
+        node.collection = ids
+        completed = self.sched.collection_is_completed
+        self.sched.addnode_collection(node, ids)
+        if self.sched.collection_is_completed and not completed:
             if self.terminal:
                 self.trdist.ensure_show_status()
                 self.terminal.write_line("")
@@ -312,18 +824,49 @@ class DSession:
 
             self.sched.init_distribute()
 
+    def slave_stolen(self, node, indices):
+        self.sched.remove_stolen(node, indices)
+
     def slave_logstart(self, node, nodeid, location):
         self.config.hook.pytest_runtest_logstart(
             nodeid=nodeid, location=location)
 
-    def slave_testreport(self, node, rep):
+    def slave_testreport(self, node, rep, index=None, rss=None):
         if not (rep.passed and rep.when != "call"):
-            if rep.when in ("setup", "call"):
-                self.sched.remove_item(node, rep.nodeid)
+            # a --boxed item whose forked child crashed only gets a
+            # single failed report, which has no setup/call phase
+            if rep.when != "teardown" and index is not None:
+                self.sched.remove_item(node, index)
         #self.report_line("testreport %s: %s" %(rep.id, rep.status))
+        if self.timings is not None:
+            self.timings.add(rep.nodeid, getattr(rep, "duration", 0.0))
         rep.node = node
         self.config.hook.pytest_runtest_logreport(report=rep)
         self._handlefailures(rep)
+        if rep.when == "teardown" and index is not None:
+            self._check_recycle(node, rss)
+
+    def _check_recycle(self, node, rss):
+        """ replace the node if it ran too many tests or uses too much
+        memory, after it gave back the items it did not start. """
+        if node in self._retired or self.shuttingdown:
+            return
+        count = self._node2testcount.get(node, 0) + 1
+        self._node2testcount[node] = count
+        if self.maxslavetests and count >= self.maxslavetests:
+            reason = "ran %d tests" % (count,)
+        elif self.maxslaverss and rss is not None and \
+             rss > self.maxslaverss * 1024 * 1024:
+            reason = "uses %d MB of memory" % (rss // (1024 * 1024),)
+        else:
+            return
+        if not self.sched.retire_node(node):
+            return
+        self._retired.add(node)
+        self.report_line("[%s] replacing slave which %s" % (
+            node.gateway.id, reason))
+        self.shutdown_node(node)
+        self.start_node(node.gateway.spec)
 
     def slave_collectreport(self, node, rep):
         if rep.failed:
@@ -347,17 +890,27 @@ class DSession:
     def triggershutdown(self):
         self.log("triggering shutdown")
         self.shuttingdown = True
-        for node in self.sched.node2pending:
+        for node in list(self.sched.node2pending):
+            self.shutdown_node(node)
+        self._check_finished()
+
+    def shutdown_node(self, node):
+        """ tell the node to shut down unless it was told already. """
+        if self.sched.shutdown_node(node):
             node.shutdown()
 
     def handle_crashitem(self, nodeid, slave):
         # XXX get more reporting info by recording pytest_runtest_logstart?
+        msg = "Slave %r crashed while running %r" %(slave.gateway.id, nodeid)
+        self.report_failure(nodeid, msg, slave)
+
+    def report_failure(self, nodeid, msg, slave=None):
         runner = self.config.pluginmanager.getplugin("runner")
         fspath = nodeid.split("::")[0]
-        msg = "Slave %r crashed while running %r" %(slave.gateway.id, nodeid)
         rep = runner.TestReport(nodeid, (fspath, None, fspath), (),
             "failed", msg, "???")
-        rep.node = slave
+        if slave is not None:
+            rep.node = slave
         self.config.hook.pytest_runtest_logreport(report=rep)
 
 class TerminalDistReporter:
@@ -415,6 +968,8 @@ class TerminalDistReporter:
             infoline = "[%s] Python %s" %(
                 d['id'],
                 d['version'].replace('\n', ' -- '),)
+            if node.startuptime is not None:
+                infoline += " [started in %.2fs]" % node.startuptime
             self.rewrite(infoline, newline=True)
         self.setstatus(node.gateway.spec, "ok")
 
@@ -8,29 +8,44 @@
 """
 
 import py, pytest
-import sys
+import sys, os
 import execnet
+from xdist.remote import covers
 
 def looponfail_main(config):
     remotecontrol = RemoteControl(config)
     rootdirs = config.getini("looponfailroots")
-    statrecorder = StatRecorder(rootdirs)
+    statrecorder = makerecorder(rootdirs)
+    changed = None
     try:
         while 1:
-            remotecontrol.loop_once()
-            if not remotecontrol.failures and remotecontrol.wasfailing:
+            remotecontrol.loop_once(changed)
+            changed = None
+            if not remotecontrol.failures and (remotecontrol.wasfailing or
+                                               remotecontrol.selected):
                 continue # the last failures passed, let's immediately rerun all
             repr_pytest_looponfailinfo(
                 failreports=remotecontrol.failures,
                 rootdirs=rootdirs)
-            statrecorder.waitonchange(checkinterval=2.0)
+            changed = statrecorder.waitonchange(checkinterval=2.0)
     except KeyboardInterrupt:
         print()
+    remotecontrol.teardown_zygote()
 
 class RemoteControl(object):
     def __init__(self, config):
         self.config = config
         self.failures = []
+        # node id -> the files a test depended on when it last ran
+        self.deps = {}
+        # path of a test module -> its node id
+        self.modules = {}
+        self.selected = False
+        self.zygote = None
+        # modules from outside the looponfailroots the last run imported
+        self.preload = []
+        # modules which import modules from below the looponfailroots
+        self.unsafe = set()
 
     def trace(self, *args):
         if self.config.option.debug:
@@ -38,8 +53,52 @@ class RemoteControl(object):
             py.builtin.print_("RemoteControl:", msg)
 
     def initgateway(self):
+        if self.config.getvalue("zygote"):
+            try:
+                return self.makezygotegateway()
+            except KeyboardInterrupt:
+                raise
+            except Exception:
+                # e.g. a preloaded module killed the zygote, the next
+                # run starts a new one
+                self.trace("zygote failed:", sys.exc_info()[1])
+                self.teardown_zygote()
         return execnet.makegateway("popen")
 
+    def makezygotegateway(self):
+        """ fork the slave session from the zygote, which keeps the
+        modules from outside the looponfailroots imported. """
+        from xdist.slavemanage import Zygote
+        while 1:
+            if self.zygote is None:
+                self.zygote = Zygote()
+                self.group = execnet.Group()
+            names = [name for name in self.preload
+                     if name not in self.unsafe]
+            tainting = self.zygote.preload(
+                names, self.config.getini("looponfailroots"))
+            if not tainting:
+                break
+            # the zygote would fork stale code once the project changes
+            self.trace("restarting zygote, project modules imported by",
+                       tainting)
+            self.unsafe.update(tainting)
+            self.teardown_zygote()
+        spec = execnet.XSpec("popen")
+        self.group.allocate_id(spec)
+        return self.zygote.makegateway(self.group, spec)
+
+    def teardown_zygote(self):
+        if self.zygote is not None:
+            zygote, self.zygote = self.zygote, None
+            self.group.terminate(timeout=1.0)
+            try:
+                zygote.exit()
+            except (IOError, EOFError):
+                # the zygote died already
+                zygote.group.terminate(timeout=1.0)
+                zygote.tmpdir.remove(ignore_errors=True)
+
     def setup(self, out=None):
         if out is None:
             out = py.io.TerminalWriter()
@@ -68,12 +127,17 @@ class RemoteControl(object):
             self.gateway.exit()
             del self.gateway
 
-    def runsession(self):
+    def runsession(self, trails=None):
+        if trails is None:
+            trails = self.failures
         try:
-            self.trace("sending", self.failures)
-            self.channel.send(self.failures)
+            self.trace("sending", trails)
+            self.channel.send(trails)
             try:
-                return self.channel.receive()
+                result = self.channel.receive()
+                self.recorddeps(*self.channel.receive())
+                self.preload = self.channel.receive()
+                return result
             except self.channel.RemoteError:
                 e = sys.exc_info()[1]
                 self.trace("ERROR", e)
@@ -81,16 +145,66 @@ class RemoteControl(object):
         finally:
             self.ensure_teardown()
 
-    def loop_once(self):
+    def recorddeps(self, deps, modules, fullrun):
+        if fullrun:
+            self.deps.clear()
+            self.modules.clear()
+        for nodeid, files in deps.items():
+            self.deps[nodeid] = frozenset(files)
+        self.modules.update(modules)
+
+    def selecttests(self, changed):
+        """ return the failures and tests which depend on the changed
+        paths, or None if the dependencies are not known and all
+        failures, or all tests, need to run. """
+        if not changed or not self.deps:
+            return None
+        selected = set()
+        for path in changed:
+            if path is None:
+                return None # the watcher lost track of changes
+            path = os.path.realpath(str(path))
+            if path.endswith((".pyc", ".pyo")):
+                continue
+            if not path.endswith(".py"):
+                return None # reading data files is not traced
+            found = path in self.modules
+            if found:
+                selected.add(self.modules[path])
+            for nodeid, files in self.deps.items():
+                if path in files:
+                    selected.add(nodeid)
+                    found = True
+            if not found:
+                return None # e.g. a new test module
+        # collection errors have no dependencies
+        trails = [failure for failure in self.failures
+                  if failure not in self.deps and failure not in selected]
+        return trails + sorted(selected)
+
+    def loop_once(self, changed=None):
+        trails = self.selecttests(changed)
+        self.selected = bool(trails)
+        if trails == []:
+            self.trace("no tests depend on", changed)
+            self.wasfailing = False
+            return
         self.setup()
         self.wasfailing = self.failures and len(self.failures)
-        result = self.runsession()
+        if trails is None:
+            result = self.runsession()
+            kept = []
+        else:
+            result = self.runsession(trails)
+            # failures which do not depend on the changes still fail
+            kept = [failure for failure in self.failures
+                    if not covers(trails, failure)]
         failures, reports, collection_failed = result
         if collection_failed:
             reports = ["Collection failed, keeping previous failure set"]
         else:
             uniq_failures = []
-            for failure in failures:
+            for failure in kept + failures:
                 if failure not in uniq_failures:
                     uniq_failures.append(failure)
             self.failures = uniq_failures
@@ -135,6 +249,10 @@ class SlaveFailSession:
         self.channel = channel
         self.recorded_failures = []
         self.collection_failed = False
+        self.fullrun = False
+        # node id -> files the test depends on
+        self.deps = {}
+        self.modules = {}
         config.pluginmanager.register(self)
         config.option.looponfail = False
         config.option.usepdb = False
@@ -143,6 +261,26 @@ class SlaveFailSession:
         if self.config.option.debug:
             print(" ".join(map(str, args)))
 
+    def pytest_sessionstart(self, session):
+        # with -n/--tx the nodes record the dependencies
+        if self.config.getvalue("dist") == "no" and sys.gettrace() is None:
+            recorder = DependencyRecorder(self.rootdirs())
+            recorder.deps = self.deps
+            recorder.modules = self.modules
+            self.config.pluginmanager.register(recorder)
+
+    def rootdirs(self):
+        return [str(x) for x in self.config.getini("looponfailroots")]
+
+    def pytest_configure_node(self, node):
+        node.slaveinput['looponfailtrails'] = self.current_command
+        node.slaveinput['looponfailroots'] = self.rootdirs()
+
+    def pytest_testnodedown(self, node, error):
+        slaveoutput = getattr(node, "slaveoutput", {})
+        self.deps.update(slaveoutput.get("looponfaildeps", {}))
+        self.modules.update(slaveoutput.get("looponfailmodules", {}))
+
     def pytest_collection(self, session):
         self.session = session
         self.trails = self.current_command
@@ -150,6 +288,7 @@ class SlaveFailSession:
         try:
             items = session.perform_collect(self.trails or None)
         except pytest.UsageError:
+            self.fullrun = True
             items = session.perform_collect(None)
         hook.pytest_collection_modifyitems(session=session, config=session.config, items=items)
         hook.pytest_collection_finish(session=session)
@@ -172,6 +311,7 @@ class SlaveFailSession:
             return # in the slave we can't do much about this
         self.DEBUG("received", command)
         self.current_command = command
+        self.fullrun = not command
         self.config.hook.pytest_cmdline_main(config=self.config)
         trails, failreports = [], []
         for rep in self.recorded_failures:
@@ -180,52 +320,320 @@ class SlaveFailSession:
             loc = str(getattr(loc, 'reprcrash', loc))
             failreports.append(loc)
         self.channel.send((trails, failreports, self.collection_failed))
+        self.channel.send((self.deps, self.modules, self.fullrun))
+        self.channel.send(self.stablemodules())
+
+    def stablemodules(self):
+        """ return the names of the imported modules from outside the
+        looponfailroots, which a --zygote can import for the next run. """
+        prefixes = tuple([os.path.join(os.path.realpath(x), "")
+                          for x in self.rootdirs()])
+        names = []
+        for name, module in list(sys.modules.items()):
+            filename = getattr(module, "__file__", None)
+            if not filename or name.startswith("__"):
+                continue
+            path = os.path.realpath(os.path.abspath(filename))
+            if not path.startswith(prefixes):
+                names.append(name)
+        names.sort()
+        return names
+
+class DependencyRecorder:
+    """ plugin recording the files below rootdirs which each test
+    executed code from, including the modules imported while
+    collecting it. """
+    def __init__(self, rootdirs):
+        self.tracer = DependencyTracer(rootdirs)
+        # node id -> files the collector or test depends on
+        self.collectdeps = {}
+        self.deps = {}
+        # path of a test module -> its node id
+        self.modules = {}
+
+    def pytest_make_collect_report(self, __multicall__, collector):
+        self.tracer.start()
+        try:
+            return __multicall__.execute()
+        finally:
+            self.collectdeps[collector.nodeid] = self.tracer.stop()
+
+    def pytest_runtest_protocol(self, __multicall__, item):
+        self.tracer.start()
+        try:
+            return __multicall__.execute()
+        finally:
+            files = self.tracer.stop()
+            for node in item.listchain():
+                files.update(self.collectdeps.get(node.nodeid, ()))
+            self.deps[item.nodeid] = list(files)
+            path = os.path.realpath(str(item.fspath))
+            self.modules[path] = item.nodeid.split("::")[0]
+
+class DependencyTracer:
+    """ record the files below rootdirs which define the functions,
+    classes and modules executed while tracing. """
+    def __init__(self, rootdirs):
+        self.prefixes = tuple([os.path.join(os.path.realpath(str(x)), "")
+                               for x in rootdirs])
+        self.filenames = set()
+        # code filename -> real path if it is below rootdirs, else None
+        self.paths = {}
+
+    def trace(self, frame, event, arg):
+        # only called for "call" events, without tracing the lines
+        self.filenames.add(frame.f_code.co_filename)
+
+    def start(self):
+        self.filenames = set()
+        sys.settrace(self.trace)
+
+    def stop(self):
+        """ stop tracing and return the set of files. """
+        sys.settrace(None)
+        files = set()
+        for filename in self.filenames:
+            try:
+                path = self.paths[filename]
+            except KeyError:
+                path = os.path.realpath(os.path.abspath(filename))
+                if not path.startswith(self.prefixes):
+                    path = None
+                self.paths[filename] = path
+            if path is not None:
+                files.add(path)
+        return files
 
 class StatRecorder:
+    """ poll the files below rootdirs for changes of their mtime or
+    size.  The listing of a directory is reused while the directory's
+    mtime does not change, the files in it still need to be stat()ed
+    as modifying a file does not touch its directory. """
+    # directories modified less than this many seconds before we list
+    # them may change again without changing their mtime
+    RACY_SECONDS = 1.0
+
     def __init__(self, rootdirlist):
         self.rootdirlist = rootdirlist
+        # path -> (mtime, size)
         self.statcache = {}
+        # directory path -> (mtime, names of its entries)
+        self.dircache = {}
+        # the paths which changed in the last check
+        self.changed = []
         self.check() # snapshot state
 
-    def fil(self, p):
-        return p.check(dotfile=0)
-    def rec(self, p):
-        return p.check(dotfile=0)
-
     def waitonchange(self, checkinterval=1.0):
+        """ block until files change and return their paths. """
         while 1:
             changed = self.check()
             if changed:
-                return
+                return self.changed
             py.std.time.sleep(checkinterval)
 
+    def listdir(self, dirpath, mtime, dircache, now):
+        cached = dircache.get(dirpath)
+        if cached is not None and cached[0] == mtime:
+            names = cached[1]
+        else:
+            names = [name for name in os.listdir(dirpath)
+                     if not name.startswith(".")]
+        if mtime < now - self.RACY_SECONDS:
+            self.dircache[dirpath] = (mtime, names)
+        return names
+
     def check(self, removepycfiles=True):
+        S_ISDIR = py.std.stat.S_ISDIR
         changed = False
+        self.changed = changedpaths = []
         statcache = self.statcache
         newstat = {}
+        dircache, self.dircache = self.dircache, {}
+        now = py.std.time.time()
+        stack = []
         for rootdir in self.rootdirlist:
-            for path in rootdir.visit(self.fil, self.rec):
-                oldstat = statcache.pop(path, None)
+            try:
+                stack.append((str(rootdir), os.stat(str(rootdir)).st_mtime))
+            except OSError:
+                pass
+        while stack:
+            dirpath, dirmtime = stack.pop()
+            try:
+                names = self.listdir(dirpath, dirmtime, dircache, now)
+            except OSError:
+                continue # removed in the meantime
+            for name in names:
+                path = os.path.join(dirpath, name)
                 try:
-                    newstat[path] = curstat = path.stat()
-                except py.error.ENOENT:
-                    if oldstat:
-                        changed = True
-                else:
-                    if oldstat:
-                       if oldstat.mtime != curstat.mtime or \
-                          oldstat.size != curstat.size:
-                            changed = True
-                            py.builtin.print_("# MODIFIED", path)
-                            if removepycfiles and path.ext == ".py":
-                                pycfile = path + "c"
-                                if pycfile.check():
-                                    pycfile.remove()
-
-                    else:
-                        changed = True
+                    st = os.stat(path)
+                except OSError:
+                    continue # a removed file remains in statcache
+                if S_ISDIR(st.st_mode):
+                    stack.append((path, st.st_mtime))
+                    continue
+                newstat[path] = curstat = (st.st_mtime, st.st_size)
+                oldstat = statcache.pop(path, None)
+                if oldstat is None:
+                    changed = True
+                    changedpaths.append(path)
+                elif oldstat != curstat:
+                    changed = True
+                    changedpaths.append(path)
+                    py.builtin.print_("# MODIFIED", path)
+                    if removepycfiles and path.endswith(".py"):
+                        pycfile = path + "c"
+                        if os.path.exists(pycfile):
+                            os.remove(pycfile)
         if statcache:
             changed = True
+            changedpaths.extend(statcache)
         self.statcache = newstat
         return changed
 
+def makerecorder(rootdirlist):
+    """ return an InotifyRecorder for rootdirlist if inotify is available
+    and a polling StatRecorder otherwise. """
+    if sys.platform.startswith("linux"):
+        try:
+            return InotifyRecorder(rootdirlist)
+        except (ImportError, AttributeError, EnvironmentError):
+            pass
+    return StatRecorder(rootdirlist)
+
+class InotifyRecorder:
+    """ wait for changes below rootdirs with the linux inotify api
+    instead of polling.  Like StatRecorder it ignores dot files and
+    also compiled python files which test runs write. """
+    IN_MODIFY = 0x2
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_DELETE_SELF = 0x400
+    IN_Q_OVERFLOW = 0x4000
+    IN_IGNORED = 0x8000
+    IN_ISDIR = 0x40000000
+    IN_CLOEXEC = 0x80000
+    WATCHMASK = (IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+                 IN_CREATE | IN_DELETE | IN_DELETE_SELF)
+    # a burst of changes ends after this many seconds without changes
+    DEBOUNCE = 0.05
+
+    def __init__(self, rootdirlist):
+        import ctypes, ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6",
+                           use_errno=True)
+        self._inotify_add_watch = libc.inotify_add_watch
+        self.fd = libc.inotify_init1(self.IN_CLOEXEC)
+        if self.fd < 0:
+            self._raiseerrno()
+        self.watches = {}
+        try:
+            for rootdir in rootdirlist:
+                self.addwatches(py.path.local(rootdir))
+        except EnvironmentError:
+            self.close()
+            raise
+
+    def _raiseerrno(self):
+        import ctypes
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno))
+
+    def close(self):
+        os.close(self.fd)
+
+    def fil(self, p):
+        return p.check(dir=1, dotfile=0) and p.basename != "__pycache__"
+    rec = fil
+
+    def ignored(self, name):
+        return (name.startswith(".") or name == "__pycache__" or
+                name.endswith((".pyc", ".pyo")))
+
+    def addwatches(self, rootdir):
+        self.addwatch(rootdir)
+        for path in rootdir.visit(self.fil, self.rec):
+            self.addwatch(path)
+
+    def addwatch(self, path):
+        name = str(path)
+        if not isinstance(name, bytes):
+            name = name.encode(sys.getfilesystemencoding())
+        wd = self._inotify_add_watch(self.fd, name, self.WATCHMASK)
+        if wd < 0:
+            self._raiseerrno()
+        self.watches[wd] = path
+
+    def readchanges(self):
+        """ return the paths changed since the last call, None stands
+        for changes which were lost to an event queue overflow. """
+        import struct
+        changed = []
+        data = os.read(self.fd, 65536)
+        headersize = struct.calcsize("iIII")
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = struct.unpack_from("iIII", data,
+                                                           offset)
+            offset += headersize
+            name = data[offset:offset + length].rstrip("\0".encode("ascii"))
+            offset += length
+            if mask & self.IN_Q_OVERFLOW:
+                changed.append(None)
+                continue
+            dirpath = self.watches.get(wd)
+            if mask & self.IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+            if dirpath is None:
+                continue
+            if not name:
+                changed.append(dirpath)
+                continue
+            name = name.decode(sys.getfilesystemencoding())
+            if self.ignored(name):
+                continue
+            path = dirpath.join(name)
+            if mask & self.IN_ISDIR and mask & (self.IN_CREATE |
+                                                self.IN_MOVED_TO):
+                try:
+                    self.addwatches(path)
+                except EnvironmentError:
+                    pass # removed again
+            changed.append(path)
+        return changed
+
+    def select(self, timeout):
+        """ return True if events can be read within timeout seconds. """
+        select = py.std.select
+        try:
+            return bool(select.select([self.fd], [], [], timeout)[0])
+        except select.error:
+            # a signal interrupted us, e.g. SIGINT for a KeyboardInterrupt
+            if sys.exc_info()[1].args[0] != py.std.errno.EINTR:
+                raise
+            return False
+
+    def waitonchange(self, checkinterval=None):
+        """ block until files change and return their paths, with None
+        standing for lost events.  checkinterval is only accepted for
+        StatRecorder compatibility. """
+        changed = []
+        while not changed:
+            if self.select(None):
+                changed = self.readchanges()
+        while self.select(self.DEBOUNCE):
+            changed.extend(self.readchanges())
+        seen = set()
+        for path in changed:
+            if path is None or path in seen:
+                continue
+            seen.add(path)
+            py.builtin.print_("# MODIFIED", path)
+            if path.ext == ".py":
+                pycfile = path + "c"
+                if pycfile.check():
+                    pycfile.remove()
+        return changed
@@ -1,4 +1,4 @@
-import sys
+import sys, os
 import py, pytest
 
 def pytest_addoption(parser):
@@ -8,17 +8,27 @@ def pytest_addoption(parser):
            help="run tests in subprocess, wait for modified files "
                 "and re-run failing test set until all pass.")
     group._addoption('-n', dest="numprocesses", metavar="numprocesses",
-           action="store", type="int",
-           help="shortcut for '--dist=load --tx=NUM*popen'")
+           action="store",
+           help="shortcut for '--dist=load --tx=NUM*popen'.  'logical' "
+                "and 'physical' start a process per available logical cpu "
+                "or core, 'auto' also leaves room for the current system "
+                "load and the free memory")
     group.addoption('--boxed',
            action="store_true", dest="boxed", default=False,
            help="box each test run in a separate process (unix)")
     group._addoption('--dist', metavar="distmode",
-           action="store", choices=['load', 'each', 'no'],
+           action="store", choices=['load', 'loadtime', 'loadscope',
+                                     'loadfile', 'each', 'no'],
            type="choice", dest="dist", default="no",
            help=("set mode for distributing tests to exec environments.\n\n"
                  "each: send each test to each available environment.\n\n"
                  "load: send each test to available environment.\n\n"
+                 "loadtime: like load, but send the slowest tests "
+                 "(as recorded by previous runs) first.\n\n"
+                 "loadscope: like load, but send the tests of a module "
+                 "or class to the same environment.\n\n"
+                 "loadfile: like load, but send the tests of a module "
+                 "to the same environment.\n\n"
                  "(default) no: run tests inprocess, don't distribute."))
     group._addoption('--tx', dest="tx", action="append", default=[],
            metavar="xspec",
@@ -28,6 +38,37 @@ def pytest_addoption(parser):
     group._addoption('-d',
            action="store_true", dest="distload", default=False,
            help="load-balance tests.  shortcut for '--dist=load'")
+    group.addoption('--timingsfile', action="store", metavar="path",
+           dest="timingsfile", default=".xdist-timings",
+           help="file for recording test durations used by --dist=loadtime "
+                "(default: .xdist-timings)")
+    group.addoption('--max-slave-restart', action="store", type="int",
+           dest="maxslaverestart", default=None, metavar="num",
+           help="maximum number of slaves which are replaced after going "
+                "down before the test run is stopped "
+                "(default: 4 times the number of slaves)")
+    group.addoption('--max-slave-tests', action="store", type="int",
+           dest="maxslavetests", default=None, metavar="num",
+           help="replace a slave by a new one after it ran num tests "
+                "(not with --dist=each)")
+    group.addoption('--max-slave-rss', action="store", type="int",
+           dest="maxslaverss", default=None, metavar="MB",
+           help="replace a slave by a new one once its resident memory "
+                "exceeds MB megabytes (not with --dist=each)")
+    group.addoption('--zygote', action="store_true", dest="zygote",
+           default=False,
+           help="fork popen slaves from a process which imported py.test "
+                "and its plugins once, instead of starting a new "
+                "interpreter for each slave (posix only)")
+    group.addoption('--collect-once', action="store_true",
+           dest="collectonce", default=False,
+           help="collect tests once in the --zygote process before "
+                "forking the slaves, which share the collected tests "
+                "(implies --zygote)")
+    group.addoption('--setup-concurrency', action="store", type="int",
+           dest="setupconcurrency", default=None, metavar="num",
+           help="maximum number of nodes whose gateways are created at "
+                "the same time (default: 8)")
     group.addoption('--rsyncdir', action="append", default=[], metavar="dir1",
            help="add directory for rsyncing to remote tx nodes.")
 
@@ -62,14 +103,28 @@ def pytest_configure(config, __multicall__):
         from xdist.dsession import DSession
         session = DSession(config)
         config.pluginmanager.register(session, "dsession")
+    slaveinput = getattr(config, "slaveinput", {})
+    if slaveinput.get("looponfailroots") and sys.gettrace() is None:
+        # a node of a --looponfail run with -n/--tx
+        from xdist.looponfail import DependencyRecorder
+        recorder = DependencyRecorder(slaveinput["looponfailroots"])
+        config.slaveoutput["looponfaildeps"] = recorder.deps
+        config.slaveoutput["looponfailmodules"] = recorder.modules
+        config.pluginmanager.register(recorder)
 
 def check_options(config):
     if config.option.numprocesses:
-        config.option.dist = "load"
-        config.option.tx = ['popen'] * int(config.option.numprocesses)
+        num = config.option.numprocesses = getnumprocesses(config)
+        if num:
+            config.option.dist = "load"
+            config.option.tx = ['popen'] * num
     if config.option.distload:
         config.option.dist = "load"
     val = config.getvalue
+    if val("collectonce"):
+        config.option.zygote = True
+    if val("zygote") and not hasattr(os, "fork"):
+        raise pytest.UsageError("--zygote needs os.fork()")
     if not val("collectonly"):
         usepdb = config.option.usepdb  # a core option
         if val("looponfail"):
@@ -80,6 +135,137 @@ def check_options(config):
                 raise pytest.UsageError("--pdb incompatible with distributing tests.")
 
 
+# memory in MB a slave is assumed to need for -n auto if there is
+# no --max-slave-rss
+AUTO_SLAVE_MB = 256
+
+def getnumprocesses(config):
+    """ return the number of slaves asked for with -n. """
+    value = config.option.numprocesses
+    if value in ("auto", "logical", "physical"):
+        return auto_numprocesses(value, config.getvalue("maxslaverss"))
+    try:
+        return int(value)
+    except ValueError:
+        raise pytest.UsageError("-n expects a number, 'auto', 'logical' "
+                                "or 'physical', not %r" % (value,))
+
+def auto_numprocesses(mode, slavemb=None):
+    """ return the number of slaves for -n auto, logical or physical. """
+    num = logical_cpus()
+    if mode != "logical":
+        num = min(num, physical_cpus() or num)
+    if mode == "auto":
+        try:
+            load = os.getloadavg()[0]
+        except (AttributeError, OSError):
+            load = 0.0
+        num = min(num, logical_cpus() - int(round(load)))
+        memory = [x for x in (available_memory(), cgroup_memory())
+                  if x is not None]
+        if memory:
+            num = min(num, min(memory) // (slavemb or AUTO_SLAVE_MB))
+    return max(1, num)
+
+def logical_cpus():
+    """ return the number of logical cpus we may run on, taking cpu
+    affinity and the cgroup cpu quota into account. """
+    try:
+        num = len(os.sched_getaffinity(0))
+    except AttributeError:
+        import multiprocessing
+        try:
+            num = multiprocessing.cpu_count()
+        except NotImplementedError:
+            num = 1
+    quota = cpu_quota()
+    if quota:
+        num = min(num, quota)
+    return num
+
+def readvalues(path):
+    f = open(path)
+    try:
+        return f.read().split()
+    finally:
+        f.close()
+
+def cpu_quota(root="/sys/fs/cgroup"):
+    """ return the number of cpus granted by the cgroup cpu quota, None
+    if there is no quota. """
+    try:
+        quota, period = readvalues(os.path.join(root, "cpu.max"))
+    except (EnvironmentError, ValueError):
+        try:
+            quota, = readvalues(os.path.join(root, "cpu", "cpu.cfs_quota_us"))
+            period, = readvalues(os.path.join(root, "cpu",
+                                              "cpu.cfs_period_us"))
+        except (EnvironmentError, ValueError):
+            return None
+    if quota in ("max", "-1"):
+        return None
+    return max(1, -(-int(quota) // int(period)))
+
+def cgroup_memory(root="/sys/fs/cgroup"):
+    """ return the MB of memory the cgroup memory limit leaves to new
+    processes, None if there is no limit. """
+    try:
+        limit, = readvalues(os.path.join(root, "memory.max"))
+        usage, = readvalues(os.path.join(root, "memory.current"))
+    except (EnvironmentError, ValueError):
+        try:
+            limit, = readvalues(os.path.join(root, "memory",
+                                             "memory.limit_in_bytes"))
+            usage, = readvalues(os.path.join(root, "memory",
+                                             "memory.usage_in_bytes"))
+        except (EnvironmentError, ValueError):
+            return None
+    if limit == "max":
+        return None
+    # without a limit cgroup v1 reports a huge one
+    return max(0, int(limit) - int(usage)) // (1024 * 1024)
+
+def physical_cpus(cpuinfo="/proc/cpuinfo"):
+    """ return the number of cpu cores, None if unknown. """
+    cores = set()
+    physid = None
+    try:
+        f = open(cpuinfo)
+    except EnvironmentError:
+        return None
+    try:
+        for line in f:
+            key, sep, value = line.partition(":")
+            key = key.strip()
+            if key == "physical id":
+                physid = value.strip()
+            elif key == "core id":
+                cores.add((physid, value.strip()))
+    finally:
+        f.close()
+    return len(cores) or None
+
+def available_memory(meminfo="/proc/meminfo"):
+    """ return the MB of memory available to new processes, None if
+    unknown. """
+    kb = {}
+    try:
+        f = open(meminfo)
+    except EnvironmentError:
+        return None
+    try:
+        for line in f:
+            key, sep, value = line.partition(":")
+            if value.split():
+                kb[key] = int(value.split()[0])
+    finally:
+        f.close()
+    if "MemAvailable" in kb:
+        return kb["MemAvailable"] // 1024
+    if "MemFree" in kb:
+        return (kb["MemFree"] + kb.get("Buffers", 0) +
+                kb.get("Cached", 0)) // 1024
+
 def pytest_runtest_protocol(item):
     if item.config.getvalue("boxed"):
         reports = forked_run_report(item)
@@ -0,0 +1,117 @@
+"""
+    A pool of warm slaves which outlives test runs, started with::
+
+        python -m xdist.pool PATH
+
+    The pool imports py.test and its plugins once and listens on the
+    unix domain socket PATH.  For each connection, i.e. for each node
+    of a ``--tx pool=PATH`` spec, it forks a slave which takes over
+    the connection, changes to the directory and environment of the
+    master and is then bootstrapped like a popen slave.
+"""
+
+import sys, os, signal, socket, errno
+from xdist.zygote import preload, closefds, redirect, readline, \
+                         bootstrap, literal
+
+def listen(path):
+    """ return a socket listening at path, which only our user can
+    connect to as connecting means running code as our user. """
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    umask = os.umask(int("077", 8))
+    try:
+        listener.bind(path)
+    except socket.error:
+        if sys.exc_info()[1].args[0] != errno.EADDRINUSE:
+            raise
+        raise SystemExit("%s exists, remove it if no pool is serving "
+                         "there" % path)
+    finally:
+        os.umask(umask)
+    listener.listen(64)
+    return listener
+
+def serve(path):
+    """ fork a slave for each connection to path until terminated. """
+    listener = listen(path)
+    def terminate(signum, frame):
+        raise SystemExit(0)
+    signal.signal(signal.SIGTERM, terminate)
+    try:
+        preload()
+        signal.signal(signal.SIGCHLD, reap)
+        sys.stderr.write("xdist pool serving at %s (pid %d)\n" % (
+                         path, os.getpid()))
+        while 1:
+            try:
+                conn = listener.accept()[0]
+            except socket.error:
+                if sys.exc_info()[1].args[0] != errno.EINTR:
+                    raise
+                continue # interrupted by SIGCHLD
+            pid = os.fork()
+            if not pid:
+                listener.close()
+                run_slave(conn)
+            conn.close()
+    finally:
+        listener.close()
+        os.unlink(path)
+
+def reap(signum, frame):
+    """ wait for the slaves which exited. """
+    while 1:
+        try:
+            pid = os.waitpid(-1, os.WNOHANG)[0]
+        except OSError:
+            return # no slaves left
+        if not pid:
+            return
+
+def setup(cwd, env, chdir, nice):
+    """ take over the directory and environment sent by the master. """
+    os.chdir(cwd)
+    os.environ.clear()
+    os.environ.update(env)
+    # sys.path was set up from the environment of the pool
+    path = env.get("PYTHONPATH", "").split(os.pathsep)
+    for entry in reversed(path):
+        if entry and entry not in sys.path:
+            sys.path.insert(0, entry)
+    if chdir:
+        if not os.path.exists(chdir):
+            os.mkdir(chdir)
+        os.chdir(chdir)
+    if nice and hasattr(os, 'nice'):
+        os.nice(nice)
+
+def run_slave(conn):
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    # the tests wait for their own subprocesses
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+    # stopping the pool does not interrupt running slaves
+    os.setsid()
+    try:
+        redirect(conn)
+        closefds(keep=None)
+        setup(*literal(readline(0)))
+        os.write(1, ("%d\n" % os.getpid()).encode("ascii"))
+        bootstrap()
+    except:
+        import traceback
+        traceback.print_exc()
+        os._exit(1)
+    os._exit(0)
+
+def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+    if len(args) != 1:
+        raise SystemExit("usage: python -m xdist.pool PATH")
+    try:
+        serve(args[0])
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
@@ -6,25 +6,116 @@
     needs not to be installed in remote environments.
 """
 
-import sys, os
+import sys, os, time, threading
+
+class Producer:
+    """ debug logger which only formats messages when it is enabled.
+
+    Messages are passed as a format string and its arguments, which are
+    only interpolated when the message is written, so that logging
+    costs next to nothing with debugging disabled.  Like with
+    py.log.Producer, attribute access returns a producer for a
+    sub-category.
+    """
+    def __init__(self, name, enabled=True):
+        self._name = name
+        self.enabled = enabled
+
+    def __repr__(self):
+        return "<Producer %s>" % (self._name,)
+
+    def __call__(self, msg, *args):
+        if self.enabled:
+            if args:
+                msg = msg % args
+            sys.stderr.write("[%s] %s\n" % (self._name, msg))
+
+    def __getattr__(self, name):
+        if name[0] == "_":
+            raise AttributeError(name)
+        return self.__class__(self._name + ":" + name, self.enabled)
 
 class SlaveInteractor:
+    # test reports are sent in batches of at most this many reports,
+    REPORT_BATCH_SIZE = 64
+    # or once the first buffered report is this many seconds old
+    REPORT_BATCH_SECONDS = 0.1
+
     def __init__(self, config, channel):
         self.config = config
         self.slaveid = config.slaveinput.get('slaveid', "?")
-        self.log = py.log.Producer("slave-%s" % self.slaveid)
-        if not config.option.debug:
-            py.log.setconsumer(self.log._keywords, None)
+        self.log = Producer("slave-%s" % self.slaveid,
+                            enabled=config.option.debug)
         self.channel = channel
+        self.current_index = None
+        self.reportrss = config.slaveinput.get('reportrss', False)
+        self.compress = None
+        compress = config.slaveinput.get('compress')
+        if compress and compress[1] == sys.version_info[0]:
+            self.compress = compress[0]
+        self.reports = []
+        self.reportstart = None
+        # guards the buffered reports against the flush timer
+        self.reportlock = threading.Lock()
+        self.flushtimer = None
+        # junitxml and -rP show the captured output of passed tests
+        option = config.option
+        self.compactreports = not (getattr(option, "xmlpath", None) or
+            "P" in (getattr(option, "reportchars", None) or ""))
         config.pluginmanager.register(self)
 
     def sendevent(self, name, **kwargs):
-        self.log("sending", name, kwargs)
-        self.channel.send((name, kwargs))
+        if self.reports:
+            self.flushreports()
+        self.log("sending %s %s", name, kwargs)
+        self.send((name, kwargs))
+
+    def send(self, message):
+        if self.compress:
+            message = compress_message(message, self.compress)
+        self.channel.send(message)
+
+    def sendreport(self, flush=False, **kwargs):
+        """ buffer a test report, send the buffered reports if flush
+        is true or if there are enough or old enough ones. """
+        self.reportlock.acquire()
+        try:
+            if not self.reports:
+                self.reportstart = time.time()
+            self.reports.append(kwargs)
+            if flush or len(self.reports) >= self.REPORT_BATCH_SIZE or \
+               time.time() - self.reportstart >= self.REPORT_BATCH_SECONDS:
+                self._flushreports()
+            elif self.config.option.boxed and self.flushtimer is None:
+                # reports are kept across tests, don't let them wait
+                # for the next test to finish
+                self.flushtimer = threading.Timer(
+                    self.REPORT_BATCH_SECONDS, self.flushreports)
+                self.flushtimer.setDaemon(True)
+                self.flushtimer.start()
+        finally:
+            self.reportlock.release()
+
+    def flushreports(self):
+        self.reportlock.acquire()
+        try:
+            if self.reports:
+                self._flushreports()
+        finally:
+            self.reportlock.release()
+
+    def _flushreports(self):
+        if self.flushtimer is not None:
+            self.flushtimer.cancel()
+            self.flushtimer = None
+        reports = self.reports
+        self.reports = []
+        self.log("sending %d testreports", len(reports))
+        self.send(("testreports", {"reports": reports}))
 
     def pytest_internalerror(self, excrepr):
         for line in str(excrepr).split("\n"):
-            self.log("IERROR> " + line)
+            self.log("IERROR> %s", line)
 
     def pytest_sessionstart(self, session):
         self.session = session
@@ -42,52 +133,173 @@ class SlaveInteractor:
 
     def pytest_runtestloop(self, session):
         self.log("entering main loop")
-        torun = []
+        self.session = session
+        self.torun = torun = []
+        self.shutdown_received = False
         while 1:
-            name, kwargs = self.channel.receive()
-            self.log("received command %s(**%s)" % (name, kwargs))
-            if name == "runtests":
-                ids = kwargs['ids']
-                for nodeid in ids:
-                    torun.append(self._id2item[nodeid])
-            elif name == "runtests_all":
-                torun.extend(session.items)
-            self.log("items to run: %s" %(len(torun)))
-            while len(torun) >= 2:
-                item = torun.pop(0)
-                nextitem = torun[0]
-                self.config.hook.pytest_runtest_protocol(item=item,
+            # only block for new commands if there is nothing to run
+            block = len(torun) < 2 and not self.shutdown_received
+            self.process_commands(block)
+            if len(torun) >= 2 or (torun and self.shutdown_received):
+                items = session.items
+                self.current_index = index = torun.pop(0)
+                nextitem = items[torun[0]] if torun else None
+                self.config.hook.pytest_runtest_protocol(item=items[index],
                     nextitem=nextitem)
-            if name == "shutdown":
-                while torun:
-                    self.config.hook.pytest_runtest_protocol(
-                        item=torun.pop(0), nextitem=None)
+                self.current_index = None
+                # a test crashing the slave takes the buffered reports
+                # of earlier tests with it and the master could not tell
+                # which test crashed, so reports are only buffered
+                # across tests if these run in a boxed subprocess
+                if self.reports and not self.config.option.boxed:
+                    self.flushreports()
+            elif self.shutdown_received:
                 break
         return True
 
+    def process_commands(self, block):
+        """ process the commands sent by the master.
+
+        Waits for at least one command if block is true, otherwise
+        only processes commands which are already available.
+        """
+        if block and self.reports:
+            self.flushreports()
+        while 1:
+            try:
+                if block:
+                    name, kwargs = self.channel.receive()
+                else:
+                    name, kwargs = self.channel.receive(timeout=0)
+            except self.channel.TimeoutError:
+                return
+            block = False
+            if name == "compressed":
+                name, kwargs = decompress_message(kwargs)
+            self.log("received command %s(**%s)", name, kwargs)
+            if name == "runtests":
+                self.torun.extend(kwargs['indices'])
+            elif name == "runtests_all":
+                self.torun.extend(range(len(self.session.items)))
+            elif name == "steal":
+                self.steal(kwargs['indices'])
+            elif name == "sendcollection":
+                self.sendevent("collection",
+                    ids=[item.nodeid for item in self.session.items])
+            elif name == "shutdown":
+                self.shutdown_received = True
+            self.log("items to run: %s", len(self.torun))
+
+    def steal(self, indices):
+        """ give back the given items if they have not been started.
+
+        The first item to run is kept as it already got passed as the
+        'nextitem' of the previously run item.
+        """
+        indices = set(indices)
+        keep = self.torun[:1]
+        stolen = []
+        for index in self.torun[1:]:
+            if index in indices:
+                stolen.append(index)
+            else:
+                keep.append(index)
+        self.torun[:] = keep
+        self.sendevent("stolen", indices=stolen)
+
+    def pytest_collection_modifyitems(self, session, config, items):
+        # with --looponfail only the failing or affected tests run,
+        # all of them if none of these exist any more
+        trails = self.config.slaveinput.get("looponfailtrails")
+        if trails:
+            selected = [item for item in items
+                        if covers(trails, item.nodeid)]
+            if selected:
+                items[:] = selected
+
     def pytest_collection_finish(self, session):
-        self._id2item = {}
-        ids = []
-        for item in session.items:
-            self._id2item[item.nodeid] = item
-            ids.append(item.nodeid)
+        # only a digest is sent, the master asks for the full list
+        # of ids with the "sendcollection" command if it needs it
+        ids = [item.nodeid for item in session.items]
         self.sendevent("collectionfinish",
             topdir=str(session.fspath),
-            ids=ids)
+            digest=collection_digest(ids),
+            count=len(ids))
 
     #def pytest_runtest_logstart(self, nodeid, location, fspath):
     #    self.sendevent("logstart", nodeid=nodeid, location=location)
 
     def pytest_runtest_logreport(self, report):
-        data = serialize_report(report)
-        self.sendevent("testreport", data=data)
+        data = serialize_report(report, compact=self.compactreports)
+        index = self.current_index
+        if index is not None and \
+           self.session.items[index].nodeid == report.nodeid:
+            # the master knows the id from the collection
+            del data['nodeid']
+            if report.when == "teardown" and self.reportrss:
+                self.sendreport(report.failed, data=data, index=index,
+                                rss=getrss())
+            else:
+                self.sendreport(report.failed, data=data, index=index)
+        else:
+            self.sendreport(report.failed, data=data)
 
     def pytest_collectreport(self, report):
         data = serialize_report(report)
         self.sendevent("collectreport", data=data)
 
-def serialize_report(rep):
+def collection_digest(ids):
+    """ return a hex digest identifying the given list of node ids. """
+    import hashlib
+    h = hashlib.sha1()
+    for nodeid in ids:
+        if not isinstance(nodeid, bytes):
+            nodeid = nodeid.encode("utf-8")
+        h.update(("%d:" % len(nodeid)).encode("ascii"))
+        h.update(nodeid)
+    return str(h.hexdigest())
+
+def covers(trails, nodeid):
+    """ return True if the node id is one of trails or below one. """
+    for trail in trails:
+        if nodeid == trail or nodeid.startswith(trail + "::"):
+            return True
+    return False
+
+def compress_message(message, threshold):
+    """ return a "compressed" message holding the given message if it
+    takes at least threshold bytes, otherwise the message itself.
+
+    Messages are marshalled with a format all supported python versions
+    read, both sides need to run the same major python version though.
+    """
+    import marshal, zlib
+    try:
+        data = marshal.dumps(message, 2)
+    except ValueError:
+        return message
+    if len(data) < threshold:
+        return message
+    return ("compressed", {"data": zlib.compress(data)})
+
+def decompress_message(kwargs):
+    """ return the message held by a "compressed" message. """
+    import marshal, zlib
+    return marshal.loads(zlib.decompress(kwargs['data']))
+
+# attributes which are left out of compact passed test reports
+COMPACT_OMIT = ("keywords", "longrepr", "sections", "result")
+
+def serialize_report(rep, compact=False):
+    """ return a marshallable dict for the given report.
+
+    If compact is true, a passed test report leaves out its keywords
+    and captured output which the master does not show for passed tests.
+    """
     import py
+    if compact and rep.passed:
+        return dict([(name, value) for name, value in rep.__dict__.items()
+                     if name not in COMPACT_OMIT])
     d = rep.__dict__.copy()
     if hasattr(rep.longrepr, 'toterminal'):
         d['longrepr'] = str(rep.longrepr)
@@ -100,6 +312,27 @@ def serialize_report(rep):
             d[name] = None # for now
     return d
 
+def getrss():
+    """ return the resident set size of this process in bytes,
+    or its maximum if the current one is not available. """
+    try:
+        f = open("/proc/self/statm")
+        try:
+            pages = int(f.read().split()[1])
+        finally:
+            f.close()
+        return pages * os.sysconf("SC_PAGE_SIZE")
+    except (IOError, OSError, ValueError, IndexError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        return rss
+    return rss * 1024
+
 def getinfodict():
     import platform
     return dict(
@@ -111,6 +344,59 @@ def getinfodict():
         cwd = os.getcwd(),
     )
 
+class CollectedSession:
+    """ a session which a zygote configured and collected before
+    forking slaves which run its tests, see xdist/zygote.py.
+
+    In a forked slave the master's remote_exec attaches from an
+    execnet thread while the main thread runs the tests.
+    """
+    def __init__(self, config, session, reports):
+        import threading
+        self.config = config
+        self.session = session
+        self.reports = reports
+        self._attached = threading.Event()
+        self._done = threading.Event()
+
+    def attach(self, channel, slaveinput, option_dict):
+        self.channel = channel
+        self.slaveinput = slaveinput
+        self.option_dict = option_dict
+        self._attached.set()
+        self._done.wait()
+
+    def finish(self):
+        self._done.set()
+
+    def runtestloop(self, timeout):
+        """ wait for the master to attach and run the tests like a slave
+        which collected them itself. """
+        self._attached.wait(timeout)
+        if not self._attached.isSet():
+            raise EnvironmentError("master did not attach in time")
+        config, session = self.config, self.session
+        config.slaveinput.update(self.slaveinput)
+        basetemp = self.option_dict.get('basetemp')
+        if basetemp:
+            config.option.basetemp = basetemp
+            handler = getattr(config, '_tmpdirhandler', None)
+            if hasattr(handler, '_basetemp'):
+                del handler._basetemp
+        interactor = SlaveInteractor(config, self.channel)
+        interactor.pytest_sessionstart(session)
+        interactor.pytest_collection(session)
+        for data in self.reports:
+            interactor.sendevent("collectreport", data=data)
+        interactor.pytest_collection_finish(session)
+        return interactor.pytest_runtestloop(session)
+
+def setup_importpath():
+    importpath = os.getcwd()
+    sys.path.insert(0, importpath) # XXX only for remote situations
+    os.environ['PYTHONPATH'] = (importpath + os.pathsep +
+        os.environ.get('PYTHONPATH', ''))
+
 def remote_initconfig(option_dict, args):
     from _pytest.config import Config
     option_dict['plugins'].append("no:terminal")
@@ -130,14 +416,15 @@ if __name__ == '__channelexec__':
     if sys.version_info[:2] == (3,2):
         os.environ["PYTHONDONTWRITEBYTECODE"] = "1"
     slaveinput,args,option_dict = channel.receive()
-    importpath = os.getcwd()
-    sys.path.insert(0, importpath) # XXX only for remote situations
-    os.environ['PYTHONPATH'] = (importpath + os.pathsep +
-        os.environ.get('PYTHONPATH', ''))
-    #os.environ['PYTHONPATH'] = importpath
-    import py
-    config = remote_initconfig(option_dict, args)
-    config.slaveinput = slaveinput
-    config.slaveoutput = {}
-    interactor = SlaveInteractor(config, channel)
-    config.hook.pytest_cmdline_main(config=config)
+    # slaves forked by a collecting zygote already have a session
+    collected = getattr(sys.modules.get("xdist.remote"), "collected", None)
+    if collected is not None:
+        collected.attach(channel, slaveinput, option_dict)
+    else:
+        setup_importpath()
+        import py
+        config = remote_initconfig(option_dict, args)
+        config.slaveinput = slaveinput
+        config.slaveoutput = {}
+        interactor = SlaveInteractor(config, channel)
+        config.hook.pytest_cmdline_main(config=config)
@@ -1,30 +1,40 @@
 import py, pytest
-import sys, os
+import sys, os, time
 import execnet
+from execnet.gateway_socket import SocketIO
 import xdist.remote
+import xdist.zygote
+from xdist.remote import Producer, compress_message, decompress_message
 
 from _pytest import runner # XXX load dynamically
 
 class NodeManager(object):
     EXIT_TIMEOUT = 10
+    # gateways which are created at the same time by default
+    SETUP_CONCURRENCY = 8
     def __init__(self, config, specs=None, defaultchdir="pyexecnetcache"):
         self.config = config
         self._nodesready = py.std.threading.Event()
         self.trace = self.config.trace.get("nodemanager")
         self.group = execnet.Group()
+        self.zygote = None
+        self._zygotelock = py.std.threading.Lock()
         if specs is None:
             specs = self._getxspecs()
         self.specs = []
         for spec in specs:
             if not isinstance(spec, execnet.XSpec):
                 spec = execnet.XSpec(spec)
+            if spec.pool:
+                # slaves of a pool share our filesystem like popen ones
+                spec.popen = True
             if not spec.chdir and not spec.popen:
                 spec.chdir = defaultchdir
             self.group.allocate_id(spec)
             self.specs.append(spec)
         self.roots = self._getrsyncdirs()
 
-    def rsync_roots(self):
+    def rsync_roots(self, gateways=None):
         """ make sure that all remote gateways
             have the same set of roots in their
             current directory.
@@ -32,6 +42,7 @@ class NodeManager(object):
         options = {
             'ignores': self.config.getini("rsyncignore"),
             'verbose': self.config.option.verbose,
+            'gateways': gateways,
         }
         if self.roots:
             # send each rsync root
@@ -42,22 +53,136 @@ class NodeManager(object):
         assert not list(self.group)
         self.config.hook.pytest_xdist_setupnodes(config=self.config,
             specs=self.specs)
-        for spec in self.specs:
-            gw = self.group.makegateway(spec)
+        gateways = []
+        for gw in self._makegateways(self.specs):
             self.config.hook.pytest_xdist_newgateway(gateway=gw)
+            gateways.append(gw)
+        return gateways
+
+    def _makegateways(self, specs):
+        """ make the gateways for specs in up to --setup-concurrency
+        threads and yield them in the order of specs as they are ready. """
+        threading = py.std.threading
+        concurrency = self.config.getvalue("setupconcurrency")
+        if concurrency is None:
+            concurrency = self.SETUP_CONCURRENCY
+        concurrency = max(1, min(concurrency, len(specs)))
+        pending = list(specs)
+        results = {}
+        cond = threading.Condition()
+        def worker():
+            while 1:
+                with cond:
+                    if not pending or 'error' in results:
+                        return
+                    spec = pending.pop(0)
+                try:
+                    result = True, self._makegateway(spec)
+                except Exception:
+                    result = False, sys.exc_info()
+                with cond:
+                    results[spec.id] = result
+                    if not result[0]:
+                        results['error'] = result
+                    cond.notify()
+        self.trace("making %d gateways, %d at a time" % (
+            len(specs), concurrency))
+        threads = [threading.Thread(target=worker)
+                   for i in range(concurrency)]
+        for thread in threads:
+            thread.setDaemon(True)
+            thread.start()
+        try:
+            for spec in specs:
+                with cond:
+                    while spec.id not in results and 'error' not in results:
+                        cond.wait(1.0)
+                    ok, value = results.get('error') or results[spec.id]
+                if not ok:
+                    py.builtin._reraise(*value)
+                yield value
+        except:
+            # also on KeyboardInterrupt: do not start more gateways and
+            # do not wait for the ones being made, teardown_nodes
+            # terminates them with the group
+            with cond:
+                del pending[:]
+            raise
+        for thread in threads:
+            thread.join()
+
+    def _makegateway(self, spec):
+        starttime = time.time()
+        gw = self.makegateway(spec)
+        gw.starttime = starttime
+        if self.config.option.verbose > 0:
+            # fetch what the terminal reporter shows while we are threaded
+            gw._rinfo()
+        self.trace("made gateway %s in %.2fs" % (
+            gw.id, time.time() - starttime))
+        return gw
+
+    def makegateway(self, spec):
+        """ make a gateway for the given spec, forking it from the
+        zygote if --zygote is given and the spec allows for it. """
+        if spec.pool:
+            return makepoolgateway(self.group, spec)
+        if self.config.getvalue("zygote") and Zygote.canfork(spec):
+            with self._zygotelock:
+                if self.zygote is None:
+                    self.zygote = Zygote(self._getzygotecollect())
+            return self.zygote.makegateway(self.group, spec)
+        return self.group.makegateway(spec)
+
+    def _getzygotecollect(self):
+        """ return the options and args for a zygote which collects the
+        tests with --collect-once, otherwise None. """
+        if not self.config.getvalue("collectonce"):
+            return None
+        option_dict = dict(vars(self.config.option))
+        basetemp = self.config._tmpdirhandler.getbasetemp()
+        option_dict['basetemp'] = str(basetemp.join("popen-zygote"))
+        return option_dict, self.config.args
 
     def setup_nodes(self, putevent):
-        self.makegateways()
+        gateways = self.makegateways()
         self.rsync_roots()
         self.trace("setting up nodes")
-        for gateway in self.group:
-            node = SlaveController(self, gateway, self.config, putevent)
-            gateway.node = node  # to keep node alive
-            node.setup()
-            self.trace("started node %r" % node)
+        for gateway in gateways:
+            self._setup_node(gateway, putevent)
+
+    def make_node_gateway(self, spec):
+        """ make and rsync the gateway of a new node like the one of the
+        given spec, e.g. to replace a node which went down.  This may
+        run in a thread while the master keeps processing the events of
+        the other nodes. """
+        newspec = execnet.XSpec(spec._spec)
+        newspec.chdir = spec.chdir
+        newspec.popen = spec.popen
+        newspec.id = None
+        spec = newspec
+        self.group.allocate_id(spec)
+        gw = self._makegateway(spec)
+        self.rsync_roots(gateways=[gw])
+        return gw
+
+    def start_node(self, gateway, putevent):
+        """ start the node of a gateway made by make_node_gateway. """
+        self.specs.append(gateway.spec)
+        self.config.hook.pytest_xdist_newgateway(gateway=gateway)
+        return self._setup_node(gateway, putevent)
+
+    def _setup_node(self, gateway, putevent):
+        node = SlaveController(self, gateway, self.config, putevent)
+        gateway.node = node  # to keep node alive
+        node.setup()
+        self.trace("started node %r" % node)
+        return node
 
     def teardown_nodes(self):
         self.group.terminate(self.EXIT_TIMEOUT)
+        if self.zygote is not None:
+            self.zygote.exit()
 
     def _getxspecs(self):
         xspeclist = []
@@ -98,20 +223,24 @@ class NodeManager(object):
                 roots.append(root)
         return roots
 
-    def rsync(self, source, notify=None, verbose=False, ignores=None):
-        """ perform rsync to all remote hosts.
+    def rsync(self, source, notify=None, verbose=False, ignores=None,
+              gateways=None):
+        """ perform rsync to all (or the given) remote hosts.
         """
         rsync = HostRSync(source, verbose=verbose, ignores=ignores)
         seen = py.builtin.set()
-        gateways = []
-        for gateway in self.group:
+        if gateways is None:
+            gateways = list(self.group)
+        targets, gateways = gateways, []
+        channels = []
+        for gateway in targets:
             spec = gateway.spec
             if spec.popen and not spec.chdir:
                 # XXX this assumes that sources are python-packages
                 # and that adding the basedir does not hurt
-                gateway.remote_exec("""
+                channels.append(gateway.remote_exec("""
                     import sys ; sys.path.insert(0, %r)
-                """ % os.path.dirname(str(source))).waitclose()
+                """ % os.path.dirname(str(source))))
                 continue
             if spec not in seen:
                 def finished():
@@ -120,6 +249,8 @@ class NodeManager(object):
                 rsync.add_target_host(gateway, finished=finished)
                 seen.add(spec)
                 gateways.append(gateway)
+        for channel in channels:
+            channel.waitclose()
         if seen:
             self.config.hook.pytest_xdist_rsyncstart(
                 source=source,
@@ -131,6 +262,154 @@ class NodeManager(object):
                 gateways=gateways,
             )
 
+class Zygote(object):
+    """ a local subprocess which imports py.test once and forks
+    popen slaves which do not need to import it again (posix only).
+
+    If collect is given as the options and args of the slaves, the
+    zygote collects the tests and the slaves share its session.
+    """
+    # seconds to wait for a forked slave, once the zygote is ready
+    TIMEOUT = 30.0
+
+    def __init__(self, collect=None):
+        import tempfile
+        self.group = execnet.Group()
+        self.gateway = self.group.makegateway("popen//id=zygote")
+        self.channel = self.gateway.remote_exec(xdist.zygote)
+        self.channel.send(collect)
+        self.collecting = collect is not None
+        self.ready = False
+        self.preloaded = set()
+        # nodes may be set up from several threads at once
+        self.lock = py.std.threading.Lock()
+        # slaves connect back through sockets only we can access
+        self.tmpdir = py.path.local(tempfile.mkdtemp(prefix="xdist-zygote-"))
+
+    @staticmethod
+    def canfork(spec):
+        """ return True if a slave for spec can be forked, i.e. if it
+        is a popen slave with the same interpreter and environment. """
+        return bool(spec.popen and not spec.pool and not spec.python and
+            not spec.via and not spec.chdir and not spec.nice and
+            not spec.env)
+
+    def preload(self, names, roots=()):
+        """ have the zygote import the modules with the given names
+        before it forks the next slave.  Return the names whose import
+        also imported modules from below the given root directories. """
+        names = [name for name in names if name not in self.preloaded]
+        if not names:
+            return []
+        self.preloaded.update(names)
+        with self.lock:
+            self._waitready()
+            self.channel.send(("import", names, [str(x) for x in roots]))
+            return self.channel.receive()
+
+    def _waitready(self):
+        if not self.ready:
+            # the zygote may be collecting the tests, which
+            # takes as long as it takes
+            ready = self.channel.receive()
+            assert ready == "ready", ready
+            self.ready = True
+
+    def makegateway(self, group, spec):
+        """ fork a slave for the given spec and return its gateway
+        registered with group. """
+        socket = py.std.socket
+        address = str(self.tmpdir.join(spec.id))
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            listener.bind(address)
+            listener.listen(1)
+            listener.settimeout(self.TIMEOUT)
+            with self.lock:
+                self._waitready()
+                self.channel.send(address)
+                pid = self.channel.receive(self.TIMEOUT)
+            sock = listener.accept()[0]
+        finally:
+            listener.close()
+            if os.path.exists(address):
+                os.unlink(address)
+        sock.settimeout(None)
+        return bootstrap_forked(group, spec, sock, pid)
+
+    def exit(self):
+        self.channel.close()
+        timeout = NodeManager.EXIT_TIMEOUT
+        if self.collecting:
+            if self.ready:
+                # a collecting zygote exits once it stopped forking, do
+                # not write to it while its gateway shuts down
+                self.gateway.join(timeout)
+            else:
+                # interrupted while it collects, which may take forever
+                timeout = 0.5
+        self.group.terminate(timeout)
+        self.tmpdir.remove(ignore_errors=True)
+
+def makepoolgateway(group, spec):
+    """ connect to the pool serving at spec.pool (see xdist.pool) and
+    return the gateway of the slave it forked, registered with group. """
+    socket = py.std.socket
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(Zygote.TIMEOUT)
+    try:
+        sock.connect(spec.pool)
+    except socket.error:
+        sock.close()
+        raise execnet.HostNotFound("no pool serving at %s" % (spec.pool,))
+    env = dict(os.environ)
+    env.update(spec.env)
+    nice = spec.nice and int(spec.nice) or 0
+    header = (os.getcwd(), env, spec.chdir, nice)
+    sock.sendall((repr(header) + "\n").encode("utf-8"))
+    pid = int(recvline(sock))
+    sock.settimeout(None)
+    return bootstrap_forked(group, spec, sock, pid)
+
+def recvline(sock):
+    line = []
+    while 1:
+        c = sock.recv(1)
+        if not c:
+            raise EOFError("connection closed by the pool")
+        if c == "\n".encode("ascii"):
+            return "".encode("ascii").join(line).decode("ascii")
+        line.append(c)
+
+def bootstrap_forked(group, spec, sock, pid):
+    """ bootstrap the forked slave with the given pid connected through
+    sock like a popen slave and return its gateway registered with
+    group. """
+    from execnet import gateway_bootstrap
+    from execnet.gateway import Gateway
+    if spec.execmodel is None:
+        spec.execmodel = group.remote_execmodel.backend
+    io = ZygoteIO(sock, pid, group.execmodel)
+    gateway_bootstrap.bootstrap_popen(io, spec)
+    gw = Gateway(io, spec)
+    group._register(gw)
+    return gw
+
+class ZygoteIO(SocketIO):
+    """ io to a slave forked by the zygote or a pool. """
+    def __init__(self, sock, pid, execmodel):
+        self.sock = sock
+        self.execmodel = execmodel
+        self.pid = pid
+        # execnet looks for the pid of popen gateways here
+        self.popen = self
+
+    def kill(self):
+        try:
+            os.kill(self.pid, py.std.signal.SIGKILL)
+        except OSError:
+            pass
+
 class HostRSync(execnet.RSync):
     """ RSyncer that filters out common files
     """
@@ -186,6 +465,8 @@ def make_reltoroot(roots, args):
 
 class SlaveController(object):
     ENDMARK = -1
+    # messages smaller than this are not compressed by default
+    COMPRESS_THRESHOLD = 1024
 
     def __init__(self, nodemanager, gateway, config, putevent):
         self.nodemanager = nodemanager
@@ -193,10 +474,22 @@ class SlaveController(object):
         self.gateway = gateway
         self.config = config
         self.slaveinput = {'slaveid': gateway.id}
+        if config.getvalue("maxslaverss"):
+            self.slaveinput['reportrss'] = True
+        spec = gateway.spec
+        if spec.compress and not spec.popen:
+            if spec.compress is True:
+                threshold = self.COMPRESS_THRESHOLD
+            else:
+                threshold = int(spec.compress)
+            # marshalled messages only load on the same major version
+            self.slaveinput['compress'] = (threshold, sys.version_info[0])
+        self.compress = None
+        self.starttime = getattr(gateway, 'starttime', None) or time.time()
+        self.startuptime = None
         self._down = False
-        self.log = py.log.Producer("slavectl-%s" % gateway.id)
-        if not self.config.option.debug:
-            py.log.setconsumer(self.log._keywords, None)
+        self.log = Producer("slavectl-%s" % gateway.id,
+                            enabled=self.config.option.debug)
 
     def __repr__(self):
         return "<%s %s>" %(self.__class__.__name__, self.gateway.id,)
@@ -222,20 +515,26 @@ class SlaveController(object):
     def ensure_teardown(self):
         if hasattr(self, 'channel'):
             if not self.channel.isclosed():
-                self.log("closing", self.channel)
+                self.log("closing %s", self.channel)
                 self.channel.close()
             #del self.channel
         if hasattr(self, 'gateway'):
-            self.log("exiting", self.gateway)
+            self.log("exiting %s", self.gateway)
             self.gateway.exit()
             #del self.gateway
 
-    def send_runtest(self, nodeid):
-        self.sendcommand("runtests", ids=[nodeid])
+    def send_runtest_some(self, indices):
+        self.sendcommand("runtests", indices=indices)
 
     def send_runtest_all(self):
         self.sendcommand("runtests_all",)
 
+    def send_collection_request(self):
+        self.sendcommand("sendcollection")
+
+    def send_steal(self, indices):
+        self.sendcommand("steal", indices=indices)
+
     def shutdown(self):
         if not self._down:
             try:
@@ -245,11 +544,14 @@ class SlaveController(object):
 
     def sendcommand(self, name, **kwargs):
         """ send a named parametrized command to the other side. """
-        self.log("sending command %s(**%s)" % (name, kwargs))
-        self.channel.send((name, kwargs))
+        self.log("sending command %s(**%s)", name, kwargs)
+        message = (name, kwargs)
+        if self.compress:
+            message = compress_message(message, self.compress)
+        self.channel.send(message)
 
     def notify_inproc(self, eventname, **kwargs):
-        self.log("queuing %s(**%s)" % (eventname, kwargs))
+        self.log("queuing %s(**%s)", eventname, kwargs)
         self.putevent((eventname, kwargs))
 
     def process_from_remote(self, eventcall):
@@ -270,9 +572,16 @@ class SlaveController(object):
                     self._down = True
                 return
             eventname, kwargs = eventcall
-            if eventname in ("collectionstart"):
-                self.log("ignoring %s(%s)" %(eventname, kwargs))
+            if eventname == "compressed":
+                eventname, kwargs = decompress_message(kwargs)
+            if eventname == "collectionstart":
+                self.log("ignoring %s(%s)", eventname, kwargs)
             elif eventname == "slaveready":
+                compress = self.slaveinput.get('compress')
+                version = kwargs['slaveinfo']['version_info']
+                if compress and version[0] == compress[1]:
+                    self.compress = compress[0]
+                self.startuptime = time.time() - self.starttime
                 self.notify_inproc(eventname, node=self, **kwargs)
             elif eventname == "slavefinished":
                 self._down = True
@@ -280,11 +589,21 @@ class SlaveController(object):
                 self.notify_inproc("slavefinished", node=self)
             #elif eventname == "logstart":
             #    self.notify_inproc(eventname, node=self, **kwargs)
-            elif eventname in ("testreport", "collectreport", "teardownreport"):
+            elif eventname == "testreports":
+                for report in kwargs['reports']:
+                    self.process_testreport(report)
+            elif eventname in ("collectreport", "teardownreport"):
                 rep = unserialize_report(eventname, kwargs['data'])
                 self.notify_inproc(eventname, node=self, rep=rep)
             elif eventname == "collectionfinish":
+                self.notify_inproc(eventname, node=self,
+                                   digest=kwargs['digest'],
+                                   count=kwargs['count'])
+            elif eventname == "collection":
                 self.notify_inproc(eventname, node=self, ids=kwargs['ids'])
+            elif eventname == "stolen":
+                self.notify_inproc(eventname, node=self,
+                                   indices=kwargs['indices'])
             else:
                 raise ValueError("unknown event: %s" %(eventname,))
         except KeyboardInterrupt:
@@ -295,9 +614,22 @@ class SlaveController(object):
             py.builtin.print_("!" * 20, excinfo)
             self.config.pluginmanager.notify_exception(excinfo)
 
+    def process_testreport(self, kwargs):
+        data = kwargs['data']
+        index = kwargs.get('index')
+        if index is not None:
+            # reports of collected items carry their index
+            data['nodeid'] = self.collection[index]
+        rep = unserialize_report("testreport", data)
+        self.notify_inproc("testreport", node=self, rep=rep, index=index,
+                           rss=kwargs.get('rss'))
+
 def unserialize_report(name, reportdict):
     d = reportdict
     if name == "testreport":
+        # compact passed reports come without keywords and longrepr
+        d.setdefault('keywords', {})
+        d.setdefault('longrepr', None)
         return runner.TestReport(**d)
     elif name == "collectreport":
         return runner.CollectReport(**d)
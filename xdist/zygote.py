@@ -0,0 +1,227 @@
+"""
+    This module is executed in a local subprocess which imports py.test
+    and its plugins once and then forks new slave processes on request
+    of the master.  The forked slaves connect back to the master through
+    a unix domain socket and are bootstrapped like popen slaves.
+
+    With --collect-once the zygote also configures py.test and collects
+    the tests, and forks the slaves from within its runtestloop so that
+    they share the collected session.
+"""
+
+import sys, os, signal, socket
+
+# seconds a forked slave waits for the master to attach to the session
+ATTACH_TIMEOUT = 60.0
+
+def preload():
+    """ import the modules needed by every slave. """
+    import py, pytest
+    from _pytest.config import default_plugins
+    names = ["_pytest." + name for name in default_plugins]
+    names += ["pkg_resources", "xdist.plugin"]
+    importmodules(names)
+
+def importmodules(names, roots=()):
+    """ import the modules with the given names and return the names
+    whose import also imported modules from below the roots. """
+    prefixes = tuple([os.path.join(os.path.realpath(x), "")
+                      for x in roots])
+    tainting = []
+    for name in names:
+        before = set(sys.modules)
+        try:
+            __import__(name)
+        except KeyboardInterrupt:
+            raise
+        except:
+            pass # the slaves import what they need themselves
+        if prefixes and modulesbelow(set(sys.modules) - before, prefixes):
+            tainting.append(name)
+    return tainting
+
+def modulesbelow(names, prefixes):
+    """ return the names of the modules whose file is below prefixes. """
+    below = []
+    for name in names:
+        filename = getattr(sys.modules[name], "__file__", None)
+        if filename:
+            path = os.path.realpath(os.path.abspath(filename))
+            if path.startswith(prefixes):
+                below.append(name)
+    return below
+
+def closefds(keep):
+    """ close all file descriptors above stderr apart from keep. """
+    try:
+        fds = [int(fd) for fd in os.listdir("/proc/self/fd")]
+    except OSError:
+        fds = range(3, 256)
+    for fd in fds:
+        if fd > 2 and fd != keep:
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+def detach(channel):
+    """ point the file descriptors which connect the zygote to the
+    master to /dev/null, keeping them valid for the stale file objects
+    of the zygote's gateway. """
+    io = channel.gateway._io
+    devnull = os.open(os.devnull, os.O_RDWR)
+    for f in (io.infile, io.outfile):
+        os.dup2(devnull, f.fileno())
+    os.close(devnull)
+
+# bootstrapping replaces sys.stdin and sys.stdout, the old ones are kept
+# referenced here to not have them close the new file descriptors 0 and 1
+inherited = []
+
+def connect(address):
+    """ connect stdin and stdout of a forked slave to the master. """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(address)
+    redirect(sock)
+
+def redirect(sock):
+    """ make the connected sock stdin and stdout of a forked slave. """
+    inherited.extend([sys.stdin, sys.stdout, sys.__stdin__, sys.__stdout__])
+    os.dup2(sock.fileno(), 0)
+    os.dup2(sock.fileno(), 1)
+    sock.close()
+    # get a fresh execnet instead of the one serving the zygote
+    for name in list(sys.modules):
+        if name == "execnet" or name.startswith("execnet."):
+            del sys.modules[name]
+
+def readline(fd):
+    """ read a line byte by byte so that no input gets buffered. """
+    line = []
+    while 1:
+        c = os.read(fd, 1)
+        if not c:
+            raise EOFError("connection closed before bootstrapping")
+        if c == "\n".encode("ascii"):
+            return "".encode("ascii").join(line).decode("utf-8")
+        line.append(c)
+
+def literal(line):
+    """ return the value of the python literal in line. """
+    from ast import literal_eval
+    return literal_eval(line)
+
+def bootstrap():
+    """ serve the master like a "python -c" popen slave does. """
+    source = literal(readline(0))
+    exec(compile(source, "<bootstrap>", "exec"), {"__name__": "__main__"})
+
+def serve_forks(channel):
+    """ fork a slave for each address the master sends and send back
+    its pid, importing the modules of preload requests in between.
+    Return the address in the slave and None in the zygote
+    once the master closed the channel. """
+    # with --collect-once the master waits for this as long as
+    # collecting takes, each fork is then answered within seconds
+    channel.send("ready")
+    children = []
+    for address in channel:
+        if isinstance(address, tuple):
+            # ("import", names, roots) of modules to preload, answered
+            # with the names which imported modules from below roots
+            channel.send(importmodules(address[1], address[2]))
+            continue
+        reap(children)
+        pid = os.fork()
+        if not pid:
+            return address
+        children.append(pid)
+        channel.send(pid)
+    # kill slaves which did not exit
+    reap(children)
+    for pid in children:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except OSError:
+            pass
+
+def reap(children):
+    for pid in list(children):
+        try:
+            if os.waitpid(pid, os.WNOHANG)[0]:
+                children.remove(pid)
+        except OSError:
+            children.remove(pid)
+
+def run_slave(address):
+    try:
+        connect(address)
+        closefds(keep=None)
+        bootstrap()
+    except:
+        import traceback
+        traceback.print_exc()
+        os._exit(1)
+    os._exit(0)
+
+class CollectOnce:
+    """ plugin of the zygote's session which records the collection and
+    forks the slaves from the runtestloop. """
+    def __init__(self, channel):
+        self.channel = channel
+        self.reports = []
+        self.collected = None
+
+    def pytest_collectreport(self, report):
+        import xdist.remote
+        self.reports.append(xdist.remote.serialize_report(report))
+
+    def pytest_runtestloop(self, session):
+        import threading
+        import xdist.remote
+        collected = xdist.remote.CollectedSession(session.config, session,
+                                                  self.reports)
+        address = serve_forks(self.channel)
+        if address is None:
+            # the zygote does not finish a session it never ran
+            os._exit(0)
+        self.collected = xdist.remote.collected = collected
+        detach(self.channel)
+        connect(address)
+        # execnet serves the master in a thread, the tests run in ours
+        self.thread = threading.Thread(target=bootstrap)
+        self.thread.start()
+        return collected.runtestloop(ATTACH_TIMEOUT)
+
+    def finish(self):
+        self.collected.finish()
+        self.thread.join()
+
+def collect_once(channel, option_dict, args):
+    """ run a session in the zygote which forks slaves after collecting,
+    return if it failed before collecting the tests. """
+    import xdist.remote
+    xdist.remote.setup_importpath()
+    config = xdist.remote.remote_initconfig(option_dict, args)
+    config.slaveinput = {'slaveid': 'zygote'}
+    config.slaveoutput = {}
+    plugin = CollectOnce(channel)
+    config.pluginmanager.register(plugin)
+    try:
+        config.hook.pytest_cmdline_main(config=config)
+    finally:
+        if plugin.collected is not None:
+            plugin.finish()
+            os._exit(0)
+
+if __name__ == '__channelexec__':
+    preload()
+    collect = channel.receive()
+    if collect is not None:
+        collect_once(channel, *collect)
+    address = serve_forks(channel)
+    if address is not None:
+        run_slave(address)
+    elif collect is not None:
+        # the master waits for a collecting zygote to exit
+        os._exit(0)